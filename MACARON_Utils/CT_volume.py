@@ -0,0 +1,171 @@
+import json
+import os
+
+import SimpleITK
+import numpy
+from numpy.lib.format import open_memmap
+
+
+def get_slice_normal(dicom_ob):
+    """
+    Gets the normal to the slices of a CT series from the ImageOrientationPatient of a slice
+    :param dicom_ob: the FileDataset of a CT slice
+    :return: the row direction, the column direction and the normal as numpy arrays
+    """
+    orientation = numpy.array(dicom_ob.ImageOrientationPatient, dtype=float)
+    row_dir = orientation[:3]
+    col_dir = orientation[3:]
+    return row_dir, col_dir, numpy.cross(row_dir, col_dir)
+
+
+def get_CT_geometry(ct_slices):
+    """
+    Computes the geometry of a CT volume from its slices
+    :param ct_slices: the FileDataset objects of the CT slices, sorted along the normal to the slices
+    :return: a dictionary with shape (z, y, x), spacing, origin and direction (SimpleITK conventions, x-y-z order)
+    """
+    row_dir, col_dir, normal = get_slice_normal(ct_slices[0])
+    positions = [numpy.dot(numpy.array(ds.ImagePositionPatient, dtype=float), normal) for ds in ct_slices]
+    z_spacing = float(numpy.median(numpy.diff(positions))) if len(positions) > 1 \
+        else float(getattr(ct_slices[0], "SliceThickness", 1.0))
+    return {"shape": [len(ct_slices), int(ct_slices[0].Rows), int(ct_slices[0].Columns)],
+            "spacing": [float(ct_slices[0].PixelSpacing[1]), float(ct_slices[0].PixelSpacing[0]), z_spacing],
+            "origin": [float(x) for x in ct_slices[0].ImagePositionPatient],
+            "direction": [float(x) for x in numpy.stack([row_dir, col_dir, normal], axis=1).flatten()]}
+
+
+def sort_CT_slices(ct_slices):
+    """
+    Sorts CT slices along the normal to the slices
+    :param ct_slices: the FileDataset objects of the CT slices
+    :return: the sorted list of FileDataset objects
+    """
+    row_dir, col_dir, normal = get_slice_normal(ct_slices[0])
+    return sorted(ct_slices, key=lambda ds: numpy.dot(numpy.array(ds.ImagePositionPatient, dtype=float), normal))
+
+
+def get_stored_range(ds):
+    """
+    Gets the range of the stored values of a CT slice, from its BitsStored (or BitsAllocated) and PixelRepresentation
+    :param ds: the FileDataset of the CT slice
+    :return: the minimum and maximum stored values
+    """
+    bits = int(getattr(ds, "BitsStored", getattr(ds, "BitsAllocated", 16)))
+    if int(getattr(ds, "PixelRepresentation", 0)) == 1:
+        return -2 ** (bits - 1), 2 ** (bits - 1) - 1
+    return 0, 2 ** bits - 1
+
+
+def get_HU_dtype(ct_slices):
+    """
+    Chooses the data type of a HU-rescaled CT volume: int16 if all slices use integer rescaling and their stored
+    range, once rescaled, fits in int16, int32 if it does not, float32 for non-integer rescaling
+    :param ct_slices: the FileDataset objects of the CT slices
+    :return: the numpy data type
+    """
+    dtype = numpy.int16
+    int16 = numpy.iinfo(numpy.int16)
+    for ds in ct_slices:
+        slope = float(getattr(ds, "RescaleSlope", 1))
+        intercept = float(getattr(ds, "RescaleIntercept", 0))
+        if slope != 1 or not intercept.is_integer():
+            return numpy.float32
+        low, high = get_stored_range(ds)
+        if low + intercept < int16.min or high + intercept > int16.max:
+            dtype = numpy.int32
+    return dtype
+
+
+def build_CT_volume(ct_slices, npy_file, source=None):
+    """
+    Builds a sorted, HU-rescaled 3D CT volume from CT slices and stores it as a memory-mapped .npy file, with a
+    .json sidecar file containing its geometry
+    :param ct_slices: the FileDataset objects of the CT slices
+    :param npy_file: the path to the .npy file to write
+    :param source: a (JSON serializable) signature of the source files, stored in the geometry dictionary
+    :return: the memory-mapped volume (z, y, x) and its geometry dictionary
+    """
+    ct_slices = sort_CT_slices(ct_slices)
+    geometry = get_CT_geometry(ct_slices)
+    geometry["source"] = source
+    tmp_npy_file = get_tmp_volume_file(npy_file)
+    volume = open_memmap(tmp_npy_file, mode="w+", dtype=get_HU_dtype(ct_slices), shape=tuple(geometry["shape"]))
+    for i, ds in enumerate(ct_slices):
+        slope = float(getattr(ds, "RescaleSlope", 1))
+        intercept = float(getattr(ds, "RescaleIntercept", 0))
+        volume[i] = ds.pixel_array * slope + intercept
+    volume.flush()
+    del volume
+    commit_volume(tmp_npy_file, geometry, npy_file)
+    return load_CT_volume(npy_file)
+
+
+def get_tmp_volume_file(npy_file):
+    """
+    Gets the temporary path a volume is written to before being moved to its .npy file by commit_volume
+    :param npy_file: the path to the .npy file of the volume
+    :return: the temporary path, unique per process
+    """
+    return os.path.splitext(npy_file)[0] + "_" + str(os.getpid()) + ".tmp.npy"
+
+
+def commit_volume(tmp_npy_file, geometry, npy_file):
+    """
+    Writes the geometry sidecar of a volume written to a temporary file, and moves both files to their final paths.
+    The volume is renamed first and the sidecar last, so that concurrent readers never map a half-written volume
+    :param tmp_npy_file: the temporary .npy file, see get_tmp_volume_file
+    :param geometry: the geometry dictionary of the volume
+    :param npy_file: the path to the .npy file of the volume
+    """
+    tmp_geometry_file = get_geometry_file(tmp_npy_file)
+    with open(tmp_geometry_file, 'w') as f:
+        json.dump(geometry, f)
+    os.replace(tmp_npy_file, npy_file)
+    os.replace(tmp_geometry_file, get_geometry_file(npy_file))
+
+
+def load_CT_volume(npy_file):
+    """
+    Loads a CT volume written by build_CT_volume, memory-mapping it in read-only mode
+    :param npy_file: the path to the .npy file
+    :return: the memory-mapped volume (z, y, x) and its geometry dictionary, or None, None if missing
+    """
+    geometry_file = get_geometry_file(npy_file)
+    if not (os.path.exists(npy_file) and os.path.exists(geometry_file)):
+        return None, None
+    with open(geometry_file, 'r') as f:
+        geometry = json.load(f)
+    return numpy.load(npy_file, mmap_mode="r"), geometry
+
+
+def get_CT_image(volume, geometry):
+    """
+    Builds a SimpleITK image from a CT volume, copying it in memory
+    :param volume: the (z, y, x) volume, as returned by build_CT_volume or load_CT_volume
+    :param geometry: the geometry dictionary of the volume
+    :return: the SimpleITK Image with HU values, spacing, origin and direction of the CT series
+    """
+    image = SimpleITK.GetImageFromArray(numpy.ascontiguousarray(volume))
+    image.SetSpacing(geometry["spacing"])
+    image.SetOrigin(geometry["origin"])
+    image.SetDirection(geometry["direction"])
+    return image
+
+
+def load_CT_image(npy_file):
+    """
+    Loads a CT volume written by build_CT_volume as a SimpleITK image
+    :param npy_file: the path to the .npy file
+    :return: the SimpleITK Image, or None if missing
+    """
+    volume, geometry = load_CT_volume(npy_file)
+    return get_CT_image(volume, geometry) if volume is not None else None
+
+
+def get_geometry_file(npy_file):
+    """
+    Gets the path to the sidecar file with the geometry of a CT volume
+    :param npy_file: the path to the .npy file of the volume
+    :return: the path to the .json geometry file
+    """
+    return os.path.splitext(npy_file)[0] + ".json"
@@ -1,28 +1,31 @@
-from MACARON_Utils.DICOM_utils import load_DICOM
+from MACARON_Utils.DICOM_pool import DICOM_POOL
+from MACARON_Utils.DICOM_utils import load_DICOM, extract_DICOM_header
 
 
 class DICOMObject:
     """
-    The class containing all information related to a single DICOM (of any type)
+    The class containing all information related to a single DICOM (of any type).
+    Only the header is kept by the object: the full FileDataset is loaded on first access and held in the
+    process-wide DICOM_POOL, from which it may be evicted and then reloaded from file_name on demand
     """
 
-    def __init__(self, dicom_file):
+    def __init__(self, dicom_file, dicom_ob=None, dicom_type=None, header_only=False):
         """
         Constructor for DICOMObject
         :param dicom_file: the path to the DICOM
-        """
-        self.file_name = dicom_file
-        self.dicom_ob, self.dicom_type = load_DICOM(dicom_file)
-
-    def __init__(self, dicom_file, dicom_ob, dicom_type):
-        """
-        Constructor for DICOMObject
-        :param dicom_file: the path to the DICOM
-        :param dicom_ob: the FileDataset object
+        :param dicom_ob: the FileDataset object, loaded on first access if missing
         :param dicom_type: the DICOMType type
+        :param header_only: True if dicom_ob contains only the header tags (see DICOM_utils.HEADER_TAGS)
         """
         self.file_name = dicom_file
-        self.dicom_ob = dicom_ob
+        if dicom_ob is None:
+            dicom_ob, dicom_type = load_DICOM(dicom_file)
+            header_only = False
+        if header_only:
+            self.dicom_header = dicom_ob
+        else:
+            self.dicom_header = extract_DICOM_header(dicom_ob)
+            DICOM_POOL.put(dicom_file, dicom_ob)
         self.dicom_type = dicom_type
 
     def get_file_name(self):
@@ -32,12 +35,36 @@ class DICOMObject:
         """
         return self.file_name
 
+    def get_header(self):
+        """
+        Gets the FileDataset used to classify the DICOM, which may not contain all the tags of the file
+        :return: the (partial) FileDataset object
+        """
+        return self.dicom_header
+
     def get_object(self):
         """
-        Gets the FileDataset object
+        Gets the FileDataset object, reading the whole DICOM file if it is not in the DICOM_POOL
         :return: the FileDataset object
         """
-        return self.dicom_ob
+        dicom_ob = DICOM_POOL.get(self.file_name)
+        if dicom_ob is None:
+            dicom_ob, dicom_type = load_DICOM(self.file_name)
+            DICOM_POOL.put(self.file_name, dicom_ob)
+        return dicom_ob
+
+    def is_loaded(self):
+        """
+        Checks if the full FileDataset is in memory
+        :return: True if the whole DICOM file is in the DICOM_POOL
+        """
+        return DICOM_POOL.get(self.file_name) is not None
+
+    def release(self):
+        """
+        Removes the full FileDataset from memory, keeping the header only
+        """
+        DICOM_POOL.release(self.file_name)
 
     def get_type(self):
         """
@@ -1,4 +1,5 @@
 import copy
+import hashlib
 import math
 import os
 import SimpleITK
@@ -6,15 +7,26 @@ import numpy
 import pylab
 
 from dicompylercore import dvhcalc
-from radiomics import featureextractor
 
+from calculateDVH import get_dvhs, get_voxel_doses, get_embedded_dvhs, get_approximate_dvhs
 from MACARON_Utils import DICOM_utils
+from MACARON_Utils.CT_volume import build_CT_volume, load_CT_volume, get_CT_image
 from MACARON_Utils.DICOMType import DICOMType
 from MACARON_Utils.DICOMObject import DICOMObject
 from MACARON_Utils.DICOM_Study import DICOMStudy
-from MACARON_Utils.DICOM_utils import load_DICOM, build_DVH_info, extractPatientData
-from MACARON_Utils.general_utils import create_masks_NRRD, write_dict, clear_folder, create_CT_NRRD, complexity_indexes, \
-    create_mask_NRRD, test_NRRD, compute_metrics_stat
+from MACARON_Utils.DVH_Policy import DVHPolicy
+from MACARON_Utils.Radiomics_Profile import RadiomicsProfile
+from MACARON_Utils.DICOM_pool import DatasetCache
+from MACARON_Utils.dose_volume import build_dose_volume
+from MACARON_Utils.dose_metrics import calculate_dose_metrics, convert_to_EQD2, calculate_gEUD, \
+    calculate_subvolume_mean_dose, build_DVH
+from MACARON_Utils.voxel_doses import store_voxel_doses, load_voxel_doses
+from MACARON_Utils.radiomics_extraction import extract_radiomics, extract_multi_radiomics
+from MACARON_Utils.mask_source import MaskSource, DEFAULT_MASK_PADDING
+from MACARON_Utils.DICOM_utils import load_DICOM, load_DICOM_header, build_DVH_record, format_DVH_record, \
+    extractPatientData
+from MACARON_Utils.general_utils import create_ss_NRRD, write_dict, clear_folder, complexity_indexes, \
+    create_mask_NRRD, compute_metrics_stat
 
 import matplotlib.pyplot as plt
 
@@ -26,19 +38,28 @@ from complexity.PyComplexityMetric import (
 
 from complexity.dicomrt import RTPlan
 
+# Number of ROIs whose embedded DVH is recomputed to verify the embedded DVHs of an RT_DOSE
+DVH_VERIFY_SAMPLE = 2
+
+# Maximum relative (and absolute, in Gy) difference of mean dose between embedded and computed DVHs
+DVH_VERIFY_TOLERANCE = 0.05
+DVH_VERIFY_ABS_TOLERANCE = 0.1
 
 class DICOMGroup:
     """
     Class that contains information of a set of DICOM, including TC, RT_STRUCT, RT_DOSE, RT_PLAN
     """
 
-    def __init__(self, dicom_folder, group_name, tmp_folder):
+    def __init__(self, dicom_folder, group_name, tmp_folder, assembled=False):
         """
         Initializes a DICOMGroup to null
         :param dicom_folder: the folder to read the DICOMGroup from
+        :param assembled: True if the DICOMObjects of the group are added by the caller (e.g. grouping files by UID),
+                          so that the group is never loaded from its folder and keeps its name
         """
         self.folder = dicom_folder
         self.name = group_name
+        self.assembled = assembled
         self.tmp_folder = tmp_folder
         self.rts_object = None
         self.rtd_object = None
@@ -46,6 +67,11 @@ class DICOMGroup:
         self.tc_sequence = []
         self.structures = None
         self.dvhs = None
+        self.dvh_records = None
+        self.dvh_errors = None
+        self.dvh_metrics = None
+        self.voxel_doses = None
+        self.voxel_doses_loaded = False
         self.radiomics = None
         self.radiomics_dose = None
         self.plan_details = None
@@ -53,6 +79,12 @@ class DICOMGroup:
         self.plan_custom_metrics = None
         self.isodose_file = None
         self.radiomics_isodose = None
+        self.datasets = DatasetCache()
+        self.ct_volume = None
+        self.ct_geometry = None
+        self.ct_image = None
+        self.dose_image = None
+        self.mask_source = None
 
     def get_folder(self):
         return self.folder
@@ -63,42 +95,173 @@ class DICOMGroup:
     def get_rtp_objects(self):
         return self.rtp_objects
 
-    def load_folder(self):
+    def load_folder(self, header_only=True, catalog=None):
         """
-        Loads the DICOMGroup from a folder, initializing all class attributes but dvh
+        Loads the DICOMGroup from a folder, initializing all class attributes but dvh. Groups that were assembled by
+        the caller are not reloaded
+        :param header_only: True if files have to be classified reading their header only, leaving the full
+                            FileDataset to be loaded when a study needs it
+        :param catalog: a DICOMCatalog to skip reading headers of unchanged files (used if header_only is True)
         """
+        if self.assembled:
+            return self.has_DICOM_objects()
         self.rtp_objects = []
         if os.path.exists(os.path.dirname(self.folder)):
             for dicom_file in os.listdir(self.folder):
                 if dicom_file.endswith(("dcm", "DCM", "dicom", "DICOM")):
                     dicom_file = self.folder + "/" + dicom_file
-                    f_ob, f_type = load_DICOM(dicom_file)
-                    if f_type == DICOMType.RT_PLAN:
-                        self.rtp_objects.append(DICOMObject(dicom_file, f_ob, f_type))
-                        if hasattr(f_ob, "PatientName"):
-                            self.name = str(f_ob.PatientName)
-                    elif f_type == DICOMType.RT_STRUCT:
-                        self.rts_object = DICOMObject(dicom_file, f_ob, f_type)
-                    elif f_type == DICOMType.RT_DOSE:
-                        self.rtd_object = DICOMObject(dicom_file, f_ob, f_type)
-                    elif f_type == DICOMType.TC:
-                        self.tc_sequence.append(DICOMObject(dicom_file, f_ob, f_type))
+                    if header_only and catalog is not None:
+                        f_ob, f_type = catalog.load_header(dicom_file)
+                    elif header_only:
+                        f_ob, f_type = load_DICOM_header(dicom_file)
                     else:
-                        print("Unable to decode file '" + dicom_file + "'")
+                        f_ob, f_type = load_DICOM(dicom_file)
+                    self.add_DICOM_object(DICOMObject(dicom_file, f_ob, f_type, header_only=header_only))
                 elif dicom_file.endswith(("nrrd", "NRRD")):
                     self.isodose_file =  self.folder + "/" + dicom_file
         else:
             print("Folder '" + self.folder + "' does not exist")
+        return self.has_DICOM_objects()
+
+    def has_DICOM_objects(self):
+        """
+        Checks if at least a DICOMObject was loaded in the DICOMGroup
+        :return: True if the DICOMGroup contains a TC, RT_STRUCT, RT_DOSE or RT_PLAN
+        """
         return (len(self.rtp_objects) > 0) or (self.rts_object is not None) \
                or (self.rtd_object is not None) or (self.tc_sequence is not None and len(self.tc_sequence) > 0)
 
+    def add_DICOM_object(self, dicom_object):
+        """
+        Adds a DICOMObject to the DICOMGroup, according to its DICOMType
+        :param dicom_object: the DICOMObject to add
+        """
+        f_type = dicom_object.get_type()
+        if f_type == DICOMType.RT_PLAN:
+            self.rtp_objects.append(dicom_object)
+            if hasattr(dicom_object.get_header(), "PatientName") and not self.assembled:
+                self.name = str(dicom_object.get_header().PatientName)
+        elif f_type == DICOMType.RT_STRUCT:
+            self.rts_object = dicom_object
+        elif f_type == DICOMType.RT_DOSE:
+            self.rtd_object = dicom_object
+        elif f_type == DICOMType.TC:
+            self.tc_sequence.append(dicom_object)
+        else:
+            print("Unable to decode file '" + dicom_object.get_file_name() + "'")
+
+    def close(self):
+        """
+        Releases the datasets, caches and results of the DICOMGroup, keeping only the headers of its DICOMObjects.
+        The DICOMGroup can still be used afterwards, reloading data on demand
+        """
+        for dicom_object in self.rtp_objects + self.tc_sequence + [self.rts_object, self.rtd_object]:
+            if dicom_object is not None:
+                dicom_object.release()
+        self.datasets.clear()
+        self.ct_volume = None
+        self.ct_geometry = None
+        self.ct_image = None
+        self.dose_image = None
+        self.mask_source = None
+        self.structures = None
+        self.dvhs = None
+        self.dvh_records = None
+        self.dvh_errors = None
+        self.dvh_metrics = None
+        self.voxel_doses = None
+        self.voxel_doses_loaded = False
+        self.radiomics = None
+        self.radiomics_dose = None
+        self.plan_details = None
+        self.plan_metrics = None
+        self.plan_custom_metrics = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_dataset(self, dicom_object):
+        """
+        Gets the parsed FileDataset of a DICOMObject of the group, shared by all the studies of the group
+        :param dicom_object: the DICOMObject
+        :return: the FileDataset object
+        """
+        return self.datasets.get(dicom_object)
+
+    def get_CT_key(self):
+        """
+        Gets a short hash of the sorted SOPInstanceUIDs and paths of the CT slices of the DICOMGroup, telling apart
+        the CT series of groups sharing the same name (e.g. anonymised patients)
+        :return: the hash string, None if there is no CT series
+        """
+        if len(self.tc_sequence) == 0:
+            return None
+        slices = sorted(str(getattr(tc.get_header(), "SOPInstanceUID", "")) + "|" + tc.get_file_name()
+                        for tc in self.tc_sequence)
+        return hashlib.sha1("\n".join(slices).encode()).hexdigest()[:8]
+
+    def get_CT_volume_file(self):
+        """
+        Gets the path to the .npy file of the CT volume of the DICOMGroup in the tmp folder, unique per CT series
+        :return: the path to the .npy file
+        """
+        return self.tmp_folder + "/" + self.name + "_" + str(self.get_CT_key()) + "_ct.npy"
+
+    def get_CT_volume(self):
+        """
+        Gets the CT series of the DICOMGroup as a sorted, HU-rescaled 3D array (z, y, x) with its geometry.
+        The array is memory-mapped from a .npy file in the tmp folder, which is built once and can be shared
+        (read-only) with other consumers and processes
+        :return: the memory-mapped volume and its geometry dictionary, or None, None if there is no CT series
+        """
+        if self.ct_volume is None and len(self.tc_sequence) > 0:
+            npy_file = self.get_CT_volume_file()
+            source = [self.get_CT_key(), len(self.tc_sequence),
+                      max(os.path.getmtime(tc.get_file_name()) for tc in self.tc_sequence)]
+            self.ct_volume, self.ct_geometry = load_CT_volume(npy_file)
+            if self.ct_geometry is None or self.ct_geometry["source"] != source:
+                print("Building CT volume for '" + self.name + "'")
+                self.ct_volume = None
+                self.ct_volume, self.ct_geometry = build_CT_volume([tc.get_object() for tc in self.tc_sequence],
+                                                                   npy_file, source)
+        return self.ct_volume, self.ct_geometry
+
+    def get_CT_image(self):
+        """
+        Gets the CT series of the DICOMGroup as a SimpleITK image, built in process from its CT volume
+        :return: the SimpleITK Image, or None if there is no CT series
+        """
+        if self.ct_image is None:
+            volume, geometry = self.get_CT_volume()
+            if volume is not None:
+                self.ct_image = get_CT_image(volume, geometry)
+        return self.ct_image
+
+    def get_CT_NRRD(self):
+        """
+        Gets the CT series of the DICOMGroup as a NRRD file in the tmp folder, written from its CT image if missing.
+        Needed only by tools that read the CT from disk, e.g. plastimatch when rasterizing structures
+        :return: the path to the NRRD file, or None if there is no CT series
+        """
+        ct_nrrd = self.tmp_folder + "/" + self.name + "_" + str(self.get_CT_key()) + "_ct.nrrd"
+        if not os.path.exists(ct_nrrd):
+            ct_image = self.get_CT_image()
+            if ct_image is None:
+                return None
+            print("Need to generate CT NRRD temporary file first")
+            SimpleITK.WriteImage(ct_image, ct_nrrd)
+        return ct_nrrd
+
     def get_structures(self):
         """
         Extracts structures from the RT_STRUCTURE file of the DICOMGroup
         :return: a dictionary containing structures
         """
         if self.rts_object is not None:
-            self.structures = DICOM_utils.get_structures(self.rts_object.get_file_name())
+            self.structures = DICOM_utils.get_structures(self.get_dataset(self.rts_object))
             return self.structures
         else:
             return {}
@@ -108,7 +271,7 @@ class DICOMGroup:
         Extracts patient data from DICOM Group
         """
         if len(self.rtp_objects) > 0:
-            return extractPatientData(self.rtp_objects[0].get_object())
+            return extractPatientData(self.get_dataset(self.rtp_objects[0]))
         else:
             return None
 
@@ -117,31 +280,203 @@ class DICOMGroup:
         Extracts dose data from DICOM Group
         """
         if self.rtd_object is not None:
-            return DICOM_utils.extractDoseData(self.rtd_object.get_object())
+            return DICOM_utils.extractDoseData(self.get_dataset(self.rtd_object))
         else:
             return None
 
-    def generate_DVH(self):
+    def generate_DVH(self, rois=None, workers=1, bin_width=1, policy=DVHPolicy.PREFER_EMBEDDED, stride=1):
         """
-        Generates Dose-Volume Histogram (DVH) for the DICOMGroup and stores it in the dvh attribute
+        Generates Dose-Volume Histogram (DVH) for the DICOMGroup and stores it in the dvh attribute.
+        DVHs embedded in the RT_DOSE are used according to the policy, and only the other ROIs are computed: the
+        RT_STRUCT and RT_DOSE are then parsed, and the dose grid is decoded, once for all of them
+        :param rois: the list of ROI numbers to compute the DVH of, all structures if None
+        :param workers: number of processes computing DVHs, sharing the dose grid in shared memory
+        :param bin_width: width of the dose bins in cGy, wider bins trade DVH resolution for memory
+        :param policy: the DVHPolicy for the DVHs embedded in the RT_DOSE
+        :param stride: if greater than 1, DVHs are approximated on a dose grid (and contours) downsampled by stride,
+                        and their estimated errors are stored in the dvh_errors attribute
         :return: a dictionary containing the data to build a dvh
         """
         if self.rts_object is not None:
             if self.rtd_object is not None:
                 structures = self.get_structures()
-                self.dvhs = {}
-                for key, structure in structures.items():
-                    self.dvhs[key] = dvhcalc.get_dvh(self.rts_object.get_file_name(),
-                                                     self.rtd_object.get_file_name(),
-                                                     key)
-                    if (key in self.dvhs) and (len(self.dvhs[key].counts) and self.dvhs[key].counts[0] != 0):
-                        print('DVH found for structure ' + structure['name'])
+                rois = rois if rois is not None else list(structures.keys())
+                unknown = [roi for roi in rois if roi not in structures]
+                if len(unknown) > 0:
+                    print("Skipping ROIs missing from the RT_STRUCT: " + ", ".join(str(roi) for roi in unknown))
+                    rois = [roi for roi in rois if roi in structures]
+                dvhs = {}
+                if policy is not DVHPolicy.ALWAYS_COMPUTE:
+                    dvhs = get_embedded_dvhs(self.get_dataset(self.rtd_object), rois=rois)
+                    for roi, dvh in dvhs.items():
+                        dvh.name = structures[roi]['name']
+                    if policy is DVHPolicy.VERIFY_SAMPLE and len(dvhs) > 0:
+                        dvhs = self.verify_embedded_DVHs(dvhs, workers, bin_width)
+                    if len(dvhs) > 0:
+                        print("Using " + str(len(dvhs)) + " DVHs embedded in the RT_DOSE")
+                missing = [roi for roi in rois if roi not in dvhs]
+                self.dvh_errors = {}
+                if len(missing) > 0 and stride > 1:
+                    approximate_dvhs, self.dvh_errors = get_approximate_dvhs(
+                        self.get_dataset(self.rts_object), self.get_dataset(self.rtd_object), rois=missing,
+                        stride=stride, workers=workers, bin_width=bin_width)
+                    dvhs.update(approximate_dvhs)
+                elif len(missing) > 0:
+                    dvhs.update(get_dvhs(self.get_dataset(self.rts_object), self.get_dataset(self.rtd_object),
+                                         rois=missing, workers=workers, bin_width=bin_width))
+                skipped = [roi for roi in rois if roi not in dvhs]
+                if len(skipped) > 0:
+                    print("No DVH computed for structures: " + ", ".join(structures[roi]['name'] for roi in skipped))
+                self.dvhs = {roi: dvhs[roi] for roi in rois if roi in dvhs}
+                self.dvh_records = {key: build_DVH_record(dvh) for key, dvh in self.dvhs.items()}
+                for key, dvh in self.dvhs.items():
+                    if len(dvh.counts) and dvh.counts[0] != 0:
+                        print('DVH found for structure ' + structures[key]['name'])
             else:
                 print("No RT_DOSE file in the group")
         else:
             print("No RT_STRUCTURE file in the group")
         return self.dvhs, pylab.figure()
 
+    def verify_embedded_DVHs(self, embedded_dvhs, workers=1, bin_width=1):
+        """
+        Verifies the DVHs embedded in the RT_DOSE by computing the DVH of a sample of DVH_VERIFY_SAMPLE ROIs, evenly
+        spaced by volume, and comparing their mean dose
+        :param embedded_dvhs: the dictionary of embedded DVHs, indexed by ROI number
+        :param workers: number of processes computing DVHs
+        :param bin_width: width of the dose bins in cGy
+        :return: the embedded DVHs if they match the computed ones, or else only the computed DVHs of the sample
+        """
+        by_volume = sorted(embedded_dvhs.keys(), key=lambda roi: embedded_dvhs[roi].volume)
+        n_sample = min(DVH_VERIFY_SAMPLE, len(by_volume))
+        sample = [by_volume[(i + 1) * len(by_volume) // (n_sample + 1)] for i in range(0, n_sample)]
+        computed_dvhs = get_dvhs(self.get_dataset(self.rts_object), self.get_dataset(self.rtd_object),
+                                 rois=sample, workers=workers, bin_width=bin_width)
+        for roi in sample:
+            difference = abs(embedded_dvhs[roi].mean - computed_dvhs[roi].mean)
+            if difference > max(DVH_VERIFY_TOLERANCE * computed_dvhs[roi].mean, DVH_VERIFY_ABS_TOLERANCE):
+                print("Embedded DVH of '" + str(embedded_dvhs[roi].name) + "' differs from the computed one by " +
+                      str(round(difference, 3)) + " Gy in mean dose, computing all DVHs")
+                return computed_dvhs
+        return embedded_dvhs
+
+    def get_DVH_records(self):
+        """
+        Gets the records of the DVHs of the DICOMGroup (see DICOM_utils.build_DVH_record), generating DVHs if needed
+        :return: a dictionary of DVH records, indexed by ROI number, or None if DVHs cannot be generated
+        """
+        if self.dvh_records is None:
+            self.generate_DVH()
+        return self.dvh_records
+
+    def get_rx_dose(self):
+        """
+        Gets the prescription dose of the DICOMGroup, the highest among its RT_PLANs
+        :return: the prescription dose in cGy, or None if it is not available
+        """
+        if self.plan_details is None:
+            self.get_plan()
+        rx_doses = [plan["rxdose"] for plan in self.plan_details if "rxdose" in plan] \
+            if self.plan_details is not None else []
+        return max(rx_doses) if len(rx_doses) > 0 and max(rx_doses) > 0 else None
+
+    def get_voxel_doses(self, rois=None, persist=False):
+        """
+        Gets the dose (cGy) and volume (cm3) of the voxels of the structures of the DICOMGroup, as float32 arrays.
+        Structures are rasterized on the dose grid once, and their voxels are cached (optionally in a .npz file in
+        the tmp folder) so that DVH metrics and derived dose metrics do not repeat the work
+        :param rois: the list of ROI numbers to get the voxels of, all structures if None
+        :param persist: True to read and write the voxels from/to the tmp folder
+        :return: a dictionary of (doses, volumes) tuples indexed by ROI number, or None if RT_STRUCT or RT_DOSE miss
+        """
+        if self.rts_object is None or self.rtd_object is None:
+            print("Voxel doses need both RT_STRUCT and RT_DOSE files in the group")
+            return None
+        npz_file = self.tmp_folder + "/" + self.name + "_voxel_doses.npz"
+        source = [self.rts_object.get_file_name(), os.path.getmtime(self.rts_object.get_file_name()),
+                  self.rtd_object.get_file_name(), os.path.getmtime(self.rtd_object.get_file_name())]
+        if self.voxel_doses is None:
+            self.voxel_doses = {}
+        # Voxels computed by calls without persist are written with the first call with persist
+        unstored = False
+        if persist and not self.voxel_doses_loaded:
+            stored = load_voxel_doses(npz_file, source)
+            unstored = any(roi not in stored for roi in self.voxel_doses)
+            for roi, voxels in stored.items():
+                self.voxel_doses.setdefault(roi, voxels)
+            self.voxel_doses_loaded = True
+        rois = rois if rois is not None else list(self.get_structures().keys())
+        missing = [roi for roi in rois if roi not in self.voxel_doses]
+        if len(missing) > 0:
+            self.voxel_doses.update(get_voxel_doses(self.get_dataset(self.rts_object),
+                                                    self.get_dataset(self.rtd_object), rois=missing))
+        if persist and (len(missing) > 0 or unstored):
+            store_voxel_doses(self.voxel_doses, npz_file, source)
+        return {roi: self.voxel_doses[roi] for roi in rois}
+
+    def calculate_DVH_metrics(self, rois=None, persist=False):
+        """
+        Calculates the scalar DVH metrics (see dose_metrics.calculate_dose_metrics) of the structures of the
+        DICOMGroup from the dose and volume of their voxels, without building DVHs. Suits cohort screening where
+        full DVH curves are not needed
+        :param rois: the list of ROI numbers to compute metrics of, all structures if None
+        :param persist: True to read and write the voxels from/to the tmp folder, see get_voxel_doses
+        :return: a dictionary of metrics, indexed by ROI number
+        """
+        voxel_doses = self.get_voxel_doses(rois, persist=persist)
+        if voxel_doses is not None:
+            structures = self.get_structures()
+            rx_dose = self.get_rx_dose()
+            self.dvh_metrics = {roi: calculate_dose_metrics(structures[roi]['name'], doses, volumes, rx_dose)
+                                for roi, (doses, volumes) in voxel_doses.items()}
+        return self.dvh_metrics
+
+    def calculate_EQD2_DVH(self, fractions, alpha_beta, rois=None, bin_width=1, persist=False):
+        """
+        Calculates the cumulative DVHs of the structures of the DICOMGroup in equivalent dose in 2 Gy fractions
+        :param fractions: the number of fractions of the treatment
+        :param alpha_beta: the alpha/beta ratio of the tissues, in Gy
+        :param rois: the list of ROI numbers to compute the DVH of, all structures if None
+        :param bin_width: width of the dose bins in cGy
+        :param persist: True to read and write the voxels from/to the tmp folder, see get_voxel_doses
+        :return: a dictionary of DVH objects indexed by ROI number, or None if RT_STRUCT or RT_DOSE miss
+        """
+        voxel_doses = self.get_voxel_doses(rois, persist=persist)
+        if voxel_doses is None:
+            return None
+        structures = self.get_structures()
+        return {roi: build_DVH(structures[roi]['name'], convert_to_EQD2(doses, fractions, alpha_beta), volumes,
+                               bin_width)
+                for roi, (doses, volumes) in voxel_doses.items()}
+
+    def calculate_gEUD(self, a, rois=None, persist=False):
+        """
+        Calculates the generalized equivalent uniform dose of the structures of the DICOMGroup
+        :param a: the volume-effect parameter of the tissues
+        :param rois: the list of ROI numbers to compute the gEUD of, all structures if None
+        :param persist: True to read and write the voxels from/to the tmp folder, see get_voxel_doses
+        :return: a dictionary of gEUD values in Gy indexed by ROI number, or None if RT_STRUCT or RT_DOSE miss
+        """
+        voxel_doses = self.get_voxel_doses(rois, persist=persist)
+        if voxel_doses is None:
+            return None
+        return {roi: calculate_gEUD(doses, volumes, a) for roi, (doses, volumes) in voxel_doses.items()}
+
+    def calculate_subvolume_mean_dose(self, percentage, hottest=True, rois=None, persist=False):
+        """
+        Calculates the mean dose of the hottest (or coldest) part of the structures of the DICOMGroup
+        :param percentage: the percentage of the volume of each structure in its sub-volume
+        :param hottest: True for the hottest part of the structures, False for the coldest one
+        :param rois: the list of ROI numbers to compute the mean dose of, all structures if None
+        :param persist: True to read and write the voxels from/to the tmp folder, see get_voxel_doses
+        :return: a dictionary of mean doses in Gy indexed by ROI number, or None if RT_STRUCT or RT_DOSE miss
+        """
+        voxel_doses = self.get_voxel_doses(rois, persist=persist)
+        if voxel_doses is None:
+            return None
+        return {roi: calculate_subvolume_mean_dose(doses, volumes, percentage, hottest)
+                for roi, (doses, volumes) in voxel_doses.items()}
+
     def print_dvh(self, output_folder):
         """
         Prints the DVH to a file as a PNG
@@ -182,21 +517,22 @@ class DICOMGroup:
             self.plan_details = []
             rt_plans = []
             for plan in self.rtp_objects:
-                plan_det, rt_plan = DICOM_utils.get_plan(plan.get_file_name())
+                plan_ob = self.get_dataset(plan)
+                plan_det, rt_plan = DICOM_utils.get_plan(plan_ob)
                 if hasattr(plan_det, "date") and len(plan_det["date"]) == 0:
-                    plan_det["date"] = plan.get_object().InstanceCreationDate
+                    plan_det["date"] = plan_ob.InstanceCreationDate
                 else:
                     plan_det["date"] = "1900-01-01"
                 if hasattr(plan_det, "time") and len(plan_det["time"]) == 0:
-                    plan_det["time"] = plan.get_object().InstanceCreationTime
+                    plan_det["time"] = plan_ob.InstanceCreationTime
                 else:
                     plan_det["time"] = 1
                 if hasattr(plan_det, "label") and len(plan_det["label"]) == 0:
-                    plan_det["label"] = plan.get_object().RTPlanLabel
+                    plan_det["label"] = plan_ob.RTPlanLabel
                 else:
                     plan_det["label"] = self.name
                 if hasattr(plan_det, "name") and len(plan_det["name"]) == 0:
-                    plan_det["name"] = plan.get_object().RTPlanName
+                    plan_det["name"] = plan_ob.RTPlanName
                 else:
                     plan_det["name"] = self.name
 
@@ -207,73 +543,144 @@ class DICOMGroup:
         else:
             return [], []
 
-    def calculate_radiomics(self):
-        source_nrrd = self.tmp_folder + "/" + self.name + "_ct.nrrd"
-        mask_folder = self.tmp_folder + "/" + self.name + "_masks"
-        if self.rts_object is not None:
-            if not os.path.exists(source_nrrd):
-                print("Need to generate CT NRRD temporary file first")
-                create_CT_NRRD(ct_folder=self.folder, nrrd_filename=source_nrrd)
-            if not os.path.exists(mask_folder):
-                print("Need to generate mask NRRD temporary file first")
-                create_masks_NRRD(tmp_folder=self.tmp_folder, ct_nrrd_filename=source_nrrd,
-                                  rt_struct_filename=self.rts_object.get_file_name(),
-                                  name=self.name, rt_dose_filename=self.rtd_object.get_file_name())
-            settings = {'binWidth': 25,
-                        'resampledPixelSpacing': None,
-                        'interpolator': SimpleITK.sitkBSpline}
-
-            # Initialize feature extractor
-            extractor = featureextractor.RadiomicsFeatureExtractor(**settings)
-            extractor.enableAllFeatures()
-            self.radiomics = {}
-            for file in os.listdir(mask_folder):
-                mask_nrrd = mask_folder + "/" + file
-                if os.path.isfile(mask_nrrd) and file.endswith(".nrrd"):
-                    file = file.replace(".nrrd", "")
-                    print("Calculating Radiomic features for '" + self.name + "', structure '" + file + "'")
-                    self.radiomics[file] = extractor.execute(source_nrrd, mask_nrrd)
+    def get_dose_volume_file(self):
+        """
+        Gets the path to the .npy file of the RT_DOSE of the DICOMGroup resampled on its CT, in the tmp folder
+        :return: the path to the .npy file
+        """
+        return self.tmp_folder + "/" + self.name + "_" + str(self.get_CT_key()) + "_dose.npy"
+
+    def get_dose_image(self):
+        """
+        Gets the RT_DOSE of the DICOMGroup resampled on its CT, as a SimpleITK image with the dose in Gy. The dose grid
+        is resampled in process and memory-mapped from a .npy file in the tmp folder, built once as the CT volume
+        :return: the SimpleITK Image, or None if there is no RT_DOSE or CT series
+        """
+        if self.dose_image is None and self.rtd_object is not None and self.get_CT_image() is not None:
+            npy_file = self.get_dose_volume_file()
+            source = [str(getattr(self.rtd_object.get_header(), "SOPInstanceUID", "")), self.get_CT_key(),
+                      os.path.getmtime(self.rtd_object.get_file_name())]
+            volume, geometry = load_CT_volume(npy_file)
+            if geometry is None or geometry["source"] != source:
+                print("Building dose volume for '" + self.name + "'")
+                volume = None
+                volume, geometry = build_dose_volume(self.get_dataset(self.rtd_object), self.get_CT_image(),
+                                                     npy_file, source)
+            self.dose_image = get_CT_image(volume, geometry)
+        return self.dose_image
+
+    def get_mask_source(self, padding=DEFAULT_MASK_PADDING):
+        """
+        Gets the masks of the structures of the DICOMGroup on its CT, read once from the structure set image in the
+        tmp folder (one bit per structure), which is written by plastimatch if missing
+        :param padding: margin in voxels around the bounding box of each structure when cropping masks and images
+        :return: the MaskSource, or None if there is no RT_STRUCT or CT series
+        """
+        if self.mask_source is not None and self.mask_source.padding != padding:
+            self.mask_source = None
+        if self.mask_source is None and self.rts_object is not None and self.get_CT_image() is not None:
+            ss_nrrd = self.tmp_folder + "/" + self.name + "_ss.nrrd"
+            ss_list = self.tmp_folder + "/" + self.name + "_ss.txt"
+            if not (os.path.exists(ss_nrrd) and os.path.exists(ss_list)):
+                print("Need to generate structure set NRRD temporary file first")
+                create_ss_NRRD(tmp_folder=self.tmp_folder, rt_struct_filename=self.rts_object.get_file_name(),
+                               name=self.name, ct_nrrd_filename=self.get_CT_NRRD())
+            if os.path.exists(ss_nrrd) and os.path.exists(ss_list):
+                self.mask_source = MaskSource(ss_nrrd, ss_list, padding=padding)
+        return self.mask_source
+
+    def calculate_radiomics(self, workers=1, profile=RadiomicsProfile.FULL, costs=None):
+        """
+        Calculates the radiomic features of the structures of the DICOMGroup on its CT image
+        :param workers: number of processes extracting features, 1 to extract them in process
+        :param profile: the RadiomicsProfile of the features
+        :param costs: if not None, a dictionary filled with the time spent on each structure in seconds
+        :return: a dictionary of feature dictionaries, indexed by structure name
+        """
+        if self.get_mask_source() is not None:
+            self.radiomics = extract_radiomics(image_file=self.get_CT_volume_file(),
+                                               masks=self.get_mask_source(), workers=workers,
+                                               image=self.get_CT_image(),
+                                               description="Radiomic features for '" + self.name + "'",
+                                               profile=profile, costs=costs)
         else:
             self.radiomics = {}
-            print("Cannot compute radiomic features: Missing RT_STRUCT file")
+            print("Cannot compute radiomic features: Missing RT_STRUCT file or CT series")
         return self.radiomics
 
-    def calculate_dose_radiomics(self):
-        source_nrrd = self.tmp_folder + "/" + self.name + "_dose.nrrd"
-        ct_nrrd = self.tmp_folder + "/" + self.name + "_ct.nrrd"
-        mask_folder = self.tmp_folder + "/" + self.name + "_masks"
-        if self.rtd_object is not None:
-            if not os.path.exists(ct_nrrd):
-                print("Need to generate CT NRRD temporary file first")
-                create_CT_NRRD(ct_folder=self.folder, nrrd_filename=ct_nrrd)
-            if not os.path.exists(source_nrrd):
-                print("Need to generate DOSE NRRD temporary file first")
-                test_NRRD(nrrd_filename=source_nrrd, base_file=self.rtd_object.get_file_name(),
-                          ct_nrrd_filename=ct_nrrd)
-            if not os.path.exists(mask_folder):
-                print("Need to generate mask NRRD temporary file first")
-                create_masks_NRRD(tmp_folder=self.tmp_folder, ct_nrrd_filename=ct_nrrd,
-                                  rt_struct_filename=self.rts_object.get_file_name(),
-                                  name=self.name, rt_dose_filename=self.rtd_object.get_file_name())
-            settings = {'binWidth': 25,
-                        'resampledPixelSpacing': None,
-                        'interpolator': SimpleITK.sitkBSpline}
-
-            # Initialize feature extractor
-            extractor = featureextractor.RadiomicsFeatureExtractor(**settings)
-            extractor.enableAllFeatures()
-            self.radiomics_dose = {}
-            for file in os.listdir(mask_folder):
-                mask_nrrd = mask_folder + "/" + file
-                if os.path.isfile(mask_nrrd) and file.endswith(".nrrd"):
-                    file = file.replace(".nrrd", "")
-                    print("Calculating Radiomic Dose features for '" + self.name + "', structure '" + file + "'")
-                    self.radiomics_dose[file] = extractor.execute(source_nrrd, mask_nrrd)
+    def calculate_dose_radiomics(self, workers=1, profile=RadiomicsProfile.FULL, costs=None):
+        """
+        Calculates the radiomic features of the structures of the DICOMGroup on its RT_DOSE, resampled on the CT
+        :param workers: number of processes extracting features, 1 to extract them in process
+        :param profile: the RadiomicsProfile of the features
+        :param costs: if not None, a dictionary filled with the time spent on each structure in seconds
+        :return: a dictionary of feature dictionaries, indexed by structure name
+        """
+        if self.get_dose_image() is not None and self.get_mask_source() is not None:
+            self.radiomics_dose = extract_radiomics(image_file=self.get_dose_volume_file(),
+                                                    masks=self.get_mask_source(), workers=workers,
+                                                    image=self.get_dose_image(),
+                                                    description="Radiomic Dose features for '" + self.name + "'",
+                                                    profile=profile, costs=costs)
         else:
             self.radiomics_dose = {}
-            print("Cannot compute radiomic features for dose: Missing RT_DOSE file")
+            print("Cannot compute radiomic features for dose: Missing RT_DOSE file or CT series")
         return self.radiomics_dose
 
+    def calculate_all_radiomics(self, workers=1, profile=RadiomicsProfile.FULL, costs=None):
+        """
+        Calculates the radiomic features of the structures of the DICOMGroup on both its CT image and its RT_DOSE,
+        visiting each structure mask once. Without a dose image (no RT_DOSE) only the CT features are calculated, and
+        without structure masks none
+        :param workers: number of processes extracting features, 1 to extract them in process
+        :param profile: the RadiomicsProfile of the features
+        :param costs: if not None, a dictionary filled with the time spent on each structure (on both images) in seconds
+        :return: the CT and the dose features, as dictionaries of feature dictionaries indexed by structure name
+        """
+        if self.get_dose_image() is not None and self.get_mask_source() is not None:
+            self.radiomics, self.radiomics_dose = extract_multi_radiomics(
+                image_files=[self.get_CT_volume_file(),
+                             self.get_dose_volume_file()],
+                masks=self.get_mask_source(), workers=workers, images=[self.get_CT_image(), self.get_dose_image()],
+                descriptions=["Radiomic features for '" + self.name + "'", "Radiomic Dose features"],
+                profile=profile, costs=costs)
+        else:
+            self.calculate_radiomics(workers=workers, profile=profile, costs=costs)
+            self.radiomics_dose = {}
+            print("Cannot compute radiomic features for dose: Missing RT_DOSE file or CT series")
+        return self.radiomics, self.radiomics_dose
+
+    def measure_radiomics_profiles(self, profiles=None, workers=1):
+        """
+        Measures the cost of extracting the CT radiomic features of the structures of the DICOMGroup with different
+        profiles, to trade the coverage of features against throughput. Features are not kept
+        :param profiles: a list of RadiomicsProfile objects, all profiles if None
+        :param workers: number of processes extracting features, 1 to extract them in process
+        :return: a dictionary with the time spent on each structure in seconds, indexed by profile name
+        """
+        profile_costs = {}
+        if self.get_mask_source() is not None:
+            for profile in (profiles if profiles is not None else list(RadiomicsProfile)):
+                profile_costs[profile.value] = {}
+                extract_radiomics(image_file=self.get_CT_volume_file(),
+                                  masks=self.get_mask_source(), workers=workers, image=self.get_CT_image(),
+                                  description="'" + profile.value + "' radiomic features for '" + self.name + "'",
+                                  profile=profile, costs=profile_costs[profile.value])
+        else:
+            print("Cannot measure radiomic features: Missing RT_STRUCT file or CT series")
+        return profile_costs
+
+    def prepare_radiomics(self, studies):
+        """
+        Calculates CT and dose radiomic features in a single pass over the structure masks, if both are requested
+        by a list of studies and none of them was computed yet
+        :param studies: a list of DICOMStudy objects
+        """
+        both = DICOMStudy.ALL_RADIOMIC_FEATURES in studies or \
+            (DICOMStudy.RADIOMIC_FEATURES in studies and DICOMStudy.DOSE_RADIOMIC_FEATURES in studies)
+        if both and self.radiomics is None and self.radiomics_dose is None:
+            self.calculate_all_radiomics()
+
     DEFAULT_RTP_METRICS = [
         PyComplexityMetric,
         MeanAreaMetricEstimator,
@@ -303,7 +710,7 @@ class DICOMGroup:
             for plan in self.rtp_objects:
                 pm = {}
                 plan_imgs = {}
-                plan_info = RTPlan(filename=plan.get_file_name())
+                plan_info = RTPlan(dataset=self.get_dataset(plan))
                 if plan_info is not None:
                     plan_dict = plan_info.get_plan()
                     for metric in metrics_list:
@@ -343,10 +750,10 @@ class DICOMGroup:
 
             for plan in self.rtp_objects:
 
-                rt_ob = plan.get_object()
+                rt_ob = self.get_dataset(plan)
                 if rt_ob is not None:
 
-                    plan_dict = RTPlan(filename=plan.get_file_name()).get_plan()
+                    plan_dict = RTPlan(dataset=rt_ob).get_plan()
                     beam_index = 1
                     pcm = {}
 
@@ -510,6 +917,44 @@ class DICOMGroup:
                     print("Supplied file is not an RT_PLAN")
         return self.plan_custom_metrics
 
+    def run_studies(self, studies):
+        """
+        Computes the results of a list of studies, reusing results that were already computed (e.g. by report).
+        Studies that only produce images (PLAN_METRICS_IMG, DVH_IMG) are skipped
+        :param studies: a list of DICOMStudy objects
+        :return: a dictionary with the result of each study
+        """
+        results = {}
+        self.prepare_radiomics(studies)
+        for study in studies:
+            if study is DICOMStudy.STRUCTURES:
+                results[study] = self.structures if self.structures is not None else self.get_structures()
+            elif study is DICOMStudy.PLAN_DETAIL:
+                results[study] = self.plan_details if self.plan_details is not None else self.get_plan()[0]
+            elif study is DICOMStudy.PLAN_METRICS_DATA:
+                results[study] = self.plan_metrics if self.plan_metrics is not None \
+                    else self.calculate_RTPlan_metrics(generate_plots=False)[0]
+            elif study is DICOMStudy.RADIOMIC_FEATURES:
+                results[study] = self.radiomics if self.radiomics is not None else self.calculate_radiomics()
+            elif study is DICOMStudy.DOSE_RADIOMIC_FEATURES:
+                results[study] = self.radiomics_dose if self.radiomics_dose is not None \
+                    else self.calculate_dose_radiomics()
+            elif study is DICOMStudy.ALL_RADIOMIC_FEATURES:
+                if self.radiomics is None or self.radiomics_dose is None:
+                    self.calculate_all_radiomics()
+                results[study] = {DICOMStudy.RADIOMIC_FEATURES: self.radiomics,
+                                  DICOMStudy.DOSE_RADIOMIC_FEATURES: self.radiomics_dose}
+            elif study is DICOMStudy.DVH_DATA:
+                dvh_records = self.get_DVH_records()
+                results[study] = dvh_records if dvh_records is not None else {}
+            elif study is DICOMStudy.DVH_METRICS:
+                dvh_metrics = self.dvh_metrics if self.dvh_metrics is not None else self.calculate_DVH_metrics()
+                results[study] = dvh_metrics if dvh_metrics is not None else {}
+            elif study is DICOMStudy.CONTROL_POINT_METRICS:
+                results[study] = self.plan_custom_metrics if self.plan_custom_metrics is not None \
+                    else self.calculate_RTPlan_custom_metrics()
+        return results
+
     def report(self, studies, output_folder, clean_folder=True):
         if os.path.exists(output_folder) and os.path.isdir(output_folder):
             group_folder = output_folder + "/" + self.name + "/"
@@ -519,10 +964,11 @@ class DICOMGroup:
                     clear_folder(group_folder)
             else:
                 os.makedirs(group_folder)
-            if len(self.tc_sequence) == 0:
+            if len(self.tc_sequence) == 0 and not self.assembled:
                 print("Loading info from DICOM set")
                 self.load_folder()
             if (studies is not None) and (len(studies) > 0):
+                self.prepare_radiomics(studies)
                 for study in studies:
                     if study is DICOMStudy.STRUCTURES:
                         out_file = group_folder + "structures.csv"
@@ -549,18 +995,33 @@ class DICOMGroup:
                         write_dict(dict_obj=self.radiomics, filename=out_file, header="structure,feature,value")
                     elif study is DICOMStudy.DOSE_RADIOMIC_FEATURES:
                         out_file = group_folder + "dose_radiomic_features.csv"
-                        if self.radiomics is None:
+                        if self.radiomics_dose is None:
                             self.calculate_dose_radiomics()
                         write_dict(dict_obj=self.radiomics_dose, filename=out_file, header="structure,feature,value")
+                    elif study is DICOMStudy.ALL_RADIOMIC_FEATURES:
+                        if self.radiomics is None or self.radiomics_dose is None:
+                            self.calculate_all_radiomics()
+                        write_dict(dict_obj=self.radiomics, filename=group_folder + "radiomic_features.csv",
+                                   header="structure,feature,value")
+                        write_dict(dict_obj=self.radiomics_dose, filename=group_folder + "dose_radiomic_features.csv",
+                                   header="structure,feature,value")
                     elif study is DICOMStudy.DVH_IMG:
                         self.print_dvh(output_folder=group_folder)
                     elif study is DICOMStudy.DVH_DATA:
-                        if self.dvhs is None:
-                            self.generate_DVH()
-                        for dvh_id in self.dvhs.keys():
+                        dvh_records = self.get_DVH_records()
+                        for dvh_id in (dvh_records.keys() if dvh_records is not None else []):
                             out_file = group_folder + "dvh_data_structure_" + str(dvh_id) + ".csv"
-                            write_dict(dict_obj=build_DVH_info(self.dvhs[dvh_id]),
+                            write_dict(dict_obj=format_DVH_record(dvh_records[dvh_id]),
                                        filename=out_file, header="attribute,value")
+                        if self.dvh_errors is not None and len(self.dvh_errors) > 0:
+                            write_dict(dict_obj=self.dvh_errors, filename=group_folder + "dvh_errors.csv",
+                                       header="structure_id,error,value")
+                    elif study is DICOMStudy.DVH_METRICS:
+                        out_file = group_folder + "dvh_metrics.csv"
+                        if self.dvh_metrics is None:
+                            self.calculate_DVH_metrics()
+                        if self.dvh_metrics is not None:
+                            write_dict(dict_obj=self.dvh_metrics, filename=out_file, header="structure_id,metric,value")
                     elif study is DICOMStudy.CONTROL_POINT_METRICS:
                         self.calculate_RTPlan_custom_metrics()
                         for i in range(0, len(self.plan_custom_metrics)):
@@ -14,4 +14,6 @@ class DICOMStudy(Enum):
     PLAN_METRICS_DATA = 5
     DVH_IMG = 6
     DVH_DATA = 7
+    DVH_METRICS = 10
+    ALL_RADIOMIC_FEATURES = 11
 
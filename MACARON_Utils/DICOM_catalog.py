@@ -0,0 +1,133 @@
+import os
+import sqlite3
+import threading
+
+import pydicom
+
+from MACARON_Utils.DICOMType import DICOMType
+from MACARON_Utils.DICOM_utils import load_DICOM_header, get_frame_of_reference, get_referenced_UIDs
+
+# Version of the catalog table layout: catalogs with a different version are rebuilt from scratch
+CATALOG_VERSION = 2
+
+# Number of new or updated entries after which the catalog is committed to disk
+COMMIT_INTERVAL = 500
+
+
+class DICOMCatalog:
+    """
+    Persistent SQLite catalog of the headers of DICOM files, keyed by path, size and modification time.
+    Files that did not change since they were catalogued are classified (and grouped by UID) without being read again
+    """
+
+    def __init__(self, db_file):
+        """
+        Constructor for DICOMCatalog, creating the catalog if it does not exist
+        :param db_file: the path to the SQLite file of the catalog
+        """
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != CATALOG_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS dicom_file")
+            self.db.execute("PRAGMA user_version = " + str(CATALOG_VERSION))
+        self.db.execute("CREATE TABLE IF NOT EXISTS dicom_file ("
+                        "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, "
+                        "sop_class_uid TEXT, sop_instance_uid TEXT, patient_name TEXT, "
+                        "frame_of_reference_uid TEXT, dicom_type TEXT, study_instance_uid TEXT, "
+                        "referenced_plan_uids TEXT, referenced_structure_set_uids TEXT)")
+        self.db.commit()
+
+    def load_header(self, file_path):
+        """
+        Gets the header of a DICOM file from the catalog, reading (and cataloguing) it if it is new or modified
+        :param file_path: path to the DICOM file
+        :return: the (partial) Dataset and its DICOMType, as DICOM_utils.load_DICOM_header
+        """
+        f_stat = os.stat(file_path)
+        with self.lock:
+            row = self.db.execute("SELECT sop_class_uid, sop_instance_uid, patient_name, frame_of_reference_uid, "
+                                  "dicom_type, study_instance_uid, referenced_plan_uids, "
+                                  "referenced_structure_set_uids FROM dicom_file "
+                                  "WHERE path = ? AND size = ? AND mtime = ?",
+                                  (file_path, f_stat.st_size, f_stat.st_mtime_ns)).fetchone()
+        if row is not None:
+            return build_catalog_header(row)
+        dicom_header, dicom_type = load_DICOM_header(file_path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO dicom_file VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (file_path, f_stat.st_size, f_stat.st_mtime_ns,
+                             get_tag(dicom_header, "SOPClassUID"), get_tag(dicom_header, "SOPInstanceUID"),
+                             get_tag(dicom_header, "PatientName"), get_frame_of_reference(dicom_header),
+                             dicom_type.name if dicom_type is not None else None,
+                             get_tag(dicom_header, "StudyInstanceUID"),
+                             " ".join(get_referenced_UIDs(dicom_header, "ReferencedRTPlanSequence")),
+                             " ".join(get_referenced_UIDs(dicom_header, "ReferencedStructureSetSequence"))))
+            self.pending += 1
+            if self.pending >= COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending = 0
+        return dicom_header, dicom_type
+
+    def commit(self):
+        """
+        Writes pending entries of the catalog to disk
+        """
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        """
+        Writes pending entries and closes the catalog
+        """
+        self.commit()
+        self.db.close()
+
+
+def get_tag(dicom_header, tag):
+    """
+    Gets the value of a tag as a string
+    :param dicom_header: the Dataset object
+    :param tag: the keyword of the tag
+    :return: the string value of the tag, or None if the tag is missing
+    """
+    value = getattr(dicom_header, tag, None)
+    return str(value) if value is not None else None
+
+
+def build_referenced_sequence(uids):
+    """
+    Builds a sequence of items that reference SOP instances
+    :param uids: a string of space-separated UIDs
+    :return: a Sequence with a ReferencedSOPInstanceUID item for each UID
+    """
+    ref_sequence = []
+    for uid in uids.split():
+        item = pydicom.Dataset()
+        item.ReferencedSOPInstanceUID = uid
+        ref_sequence.append(item)
+    return pydicom.Sequence(ref_sequence)
+
+
+def build_catalog_header(row):
+    """
+    Builds a Dataset with the tags stored in a row of the catalog
+    :param row: a (sop_class_uid, sop_instance_uid, patient_name, frame_of_reference_uid, dicom_type,
+                study_instance_uid, referenced_plan_uids, referenced_structure_set_uids) tuple
+    :return: the (partial) Dataset and its DICOMType
+    """
+    dicom_header = pydicom.Dataset()
+    for tag, value in zip(["SOPClassUID", "SOPInstanceUID", "PatientName", "FrameOfReferenceUID"], row[:4]):
+        if value is not None:
+            setattr(dicom_header, tag, value)
+    if row[5] is not None:
+        dicom_header.StudyInstanceUID = row[5]
+    if row[6]:
+        dicom_header.ReferencedRTPlanSequence = build_referenced_sequence(row[6])
+    if row[7]:
+        dicom_header.ReferencedStructureSetSequence = build_referenced_sequence(row[7])
+    dicom_type = DICOMType[row[4]] if row[4] is not None else None
+    return dicom_header, dicom_type
@@ -0,0 +1,200 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from MACARON_Utils.DICOMObject import DICOMObject
+from MACARON_Utils.DICOMType import DICOMType
+from MACARON_Utils.DICOM_Group import DICOMGroup
+from MACARON_Utils.DICOM_scanner import walk_DICOM_folders, DEFAULT_SCAN_WORKERS
+from MACARON_Utils.DICOM_utils import load_DICOM_header, get_frame_of_reference, get_referenced_UIDs
+
+
+def get_group_keys(dicom_header, dicom_file):
+    """
+    Gets the keys joining a DICOM file to the other files of its bucket: its StudyInstanceUID (or its folder, if the
+    StudyInstanceUID is missing), its FrameOfReferenceUID, its SOPInstanceUID and the SOPInstanceUIDs of the RT_PLAN
+    and RT_STRUCT it references. Files sharing any key end up in the same bucket, which is then split in groups by
+    split_DICOM_study
+    :param dicom_header: the (partial) Dataset of the DICOM file
+    :param dicom_file: the path to the DICOM file
+    :return: a list of keys
+    """
+    if "StudyInstanceUID" in dicom_header:
+        keys = ["study:" + str(dicom_header.StudyInstanceUID)]
+    else:
+        keys = ["folder:" + os.path.dirname(dicom_file)]
+    frame = get_frame_of_reference(dicom_header)
+    if frame is not None:
+        keys.append("frame:" + frame)
+    if "SOPInstanceUID" in dicom_header:
+        keys.append("sop:" + str(dicom_header.SOPInstanceUID))
+    for sequence_tag in ["ReferencedRTPlanSequence", "ReferencedStructureSetSequence"]:
+        keys.extend("sop:" + uid for uid in get_referenced_UIDs(dicom_header, sequence_tag))
+    return keys
+
+
+def bucket_DICOM_objects(keyed_objects):
+    """
+    Buckets DICOM objects by joining (union-find) the objects that share at least one key
+    :param keyed_objects: a list of tuples with a DICOMObject and its keys (see get_group_keys)
+    :return: a list of buckets, each one a list of DICOMObjects
+    """
+    parents = {}
+
+    def find(key):
+        root = key
+        while parents[root] != root:
+            root = parents[root]
+        while parents[key] != root:
+            parents[key], key = root, parents[key]
+        return root
+
+    for dicom_object, keys in keyed_objects:
+        for key in keys:
+            parents.setdefault(key, key)
+        for key in keys[1:]:
+            parents[find(key)] = find(keys[0])
+    buckets = {}
+    for dicom_object, keys in keyed_objects:
+        buckets.setdefault(find(keys[0]), []).append(dicom_object)
+    return list(buckets.values())
+
+
+def get_SOP_UID(dicom_object):
+    """
+    :param dicom_object: the DICOMObject
+    :return: the SOPInstanceUID of the DICOMObject, an empty string if missing
+    """
+    return str(getattr(dicom_object.get_header(), "SOPInstanceUID", ""))
+
+
+def split_DICOM_study(dicom_objects):
+    """
+    Splits the DICOM objects of a bucket in groups, one for each RT_PLAN chain: the RT_PLAN, the RT_STRUCT it references
+    (ReferencedStructureSetSequence), the RT_DOSE that references it (ReferencedRTPlanSequence) and the CT slices
+    sharing the FrameOfReferenceUID of the chain. A chain with many RT_STRUCT or RT_DOSE files makes a group for each
+    of them, and RT files outside any chain make groups on their own, so that no RT file is discarded
+    :param dicom_objects: the DICOMObjects of the bucket
+    :return: a list of groups, each one a tuple with its RT DICOMObjects and its CT slices
+    """
+    by_type = {DICOMType.RT_PLAN: [], DICOMType.RT_STRUCT: [], DICOMType.RT_DOSE: [], DICOMType.TC: []}
+    for dicom_object in dicom_objects:
+        by_type.setdefault(dicom_object.get_type(), []).append(dicom_object)
+    structures = {get_SOP_UID(rts): rts for rts in by_type[DICOMType.RT_STRUCT]}
+
+    def get_structures(dicom_object):
+        uids = get_referenced_UIDs(dicom_object.get_header(), "ReferencedStructureSetSequence")
+        return [structures[uid] for uid in uids if uid in structures]
+
+    chains = []
+    for rtp in by_type[DICOMType.RT_PLAN]:
+        rtds = [rtd for rtd in by_type[DICOMType.RT_DOSE]
+                if get_SOP_UID(rtp) in get_referenced_UIDs(rtd.get_header(), "ReferencedRTPlanSequence")]
+        for rts in (get_structures(rtp) or [None]):
+            for rtd in (rtds or [None]):
+                chains.append((rtp, rts, rtd))
+    chained = set(ob for chain in chains for ob in chain if ob is not None)
+    for rtd in by_type[DICOMType.RT_DOSE]:
+        if rtd not in chained:
+            for rts in (get_structures(rtd) or [None]):
+                chains.append((None, rts, rtd))
+    chained = set(ob for chain in chains for ob in chain if ob is not None)
+    for rts in by_type[DICOMType.RT_STRUCT]:
+        if rts not in chained:
+            chains.append((None, rts, None))
+
+    ct_slices = {}
+    for tc in by_type[DICOMType.TC]:
+        ct_slices.setdefault(get_frame_of_reference(tc.get_header()), []).append(tc)
+    groups = []
+    for rtp, rts, rtd in chains:
+        # The RT_STRUCT and the RT_DOSE share the frame of reference of the CT, the RT_PLAN may not have one
+        frames = [get_frame_of_reference(ob.get_header()) for ob in (rts, rtd, rtp) if ob is not None]
+        frame = next((frame for frame in frames if frame is not None), None)
+        groups.append(([ob for ob in (rtp, rts, rtd) if ob is not None], ct_slices.get(frame, [])))
+    used_frames = set(get_frame_of_reference(ob.get_header()) for rt_objects, tcs in groups for ob in tcs)
+    for frame, tcs in ct_slices.items():
+        if frame not in used_frames:
+            groups.append(([], tcs))
+    return groups
+
+
+def get_group_name(rt_objects, ct_slices):
+    """
+    Gets a name for a group assembled by UID, unique even among the groups of the same patient: the PatientName
+    followed by a short hash of the SOPInstanceUIDs of its RT files (or of the frame of reference of its CT)
+    :param rt_objects: the RT DICOMObjects of the group
+    :param ct_slices: the CT DICOMObjects of the group
+    :return: the name
+    """
+    name = "Group"
+    for dicom_object in rt_objects + ct_slices:
+        if "PatientName" in dicom_object.get_header():
+            name = str(dicom_object.get_header().PatientName)
+            break
+    if len(rt_objects) > 0:
+        uids = "|".join(get_SOP_UID(ob) for ob in rt_objects)
+    else:
+        uids = str(get_frame_of_reference(ct_slices[0].get_header()))
+    return name + "_" + hashlib.sha1(uids.encode()).hexdigest()[:8]
+
+
+def group_DICOM_files(dicom_files, tmp_folder, workers=DEFAULT_SCAN_WORKERS, catalog=None):
+    """
+    Builds DICOM groups from a list of DICOM files, regardless of the folders they are stored into.
+    Headers are read on a thread pool and files are bucketed in a single pass, joining them on their StudyInstanceUID,
+    FrameOfReferenceUID and referenced RT UIDs (see get_group_keys), then each bucket is split in groups by following
+    the references among its RT files (see split_DICOM_study)
+    :param dicom_files: a list of paths to DICOM files
+    :param tmp_folder: the folder for temporary files of the DICOMGroups
+    :param workers: number of threads reading DICOM headers
+    :param catalog: a DICOMCatalog to skip reading headers of unchanged files
+    :return: a list of DICOMGroup objects
+    """
+    load_header = catalog.load_header if catalog is not None else load_DICOM_header
+    keyed_objects = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        headers = [(dicom_file, executor.submit(load_header, dicom_file)) for dicom_file in dicom_files]
+        for dicom_file, header in headers:
+            try:
+                f_ob, f_type = header.result()
+            except Exception as e:
+                print("Unable to read file '" + dicom_file + "': " + str(e))
+                continue
+            if f_type is None:
+                print("Unable to decode file '" + dicom_file + "'")
+                continue
+            keyed_objects.append((DICOMObject(dicom_file, f_ob, f_type, header_only=True),
+                                  get_group_keys(f_ob, dicom_file)))
+    if catalog is not None:
+        catalog.commit()
+
+    groups = []
+    for bucket_objects in bucket_DICOM_objects(keyed_objects):
+        for rt_objects, ct_slices in split_DICOM_study(bucket_objects):
+            group_objects = rt_objects + ct_slices
+            folder = os.path.commonpath([os.path.dirname(ob.get_file_name()) for ob in group_objects])
+            dg = DICOMGroup(dicom_folder=folder, group_name=get_group_name(rt_objects, ct_slices),
+                            tmp_folder=tmp_folder, assembled=True)
+            for dicom_object in group_objects:
+                dg.add_DICOM_object(dicom_object)
+            groups.append(dg)
+    return groups
+
+
+def find_DICOM_groups_by_UID(main_folder, tmp_folder, workers=DEFAULT_SCAN_WORKERS, catalog=None):
+    """
+    Returns an array of dicom groups in the main folder, grouping files by UID instead of by folder.
+    Suits flat archives (e.g. PACS exports) where files of many patients share the same folder
+    @param main_folder: root folder
+    @param tmp_folder: the folder for temporary files of the DICOMGroups
+    @param workers: number of threads reading DICOM headers
+    @param catalog: a DICOMCatalog to skip reading headers of unchanged files
+    @return: array of dicom groups
+    """
+    dicom_files = [dicom_file for folder, folder_files, nrrd_files in walk_DICOM_folders(main_folder)
+                   for dicom_file in folder_files]
+    groups = group_DICOM_files(dicom_files, tmp_folder, workers, catalog)
+    for i in range(0, len(groups)):
+        print("Found Patient #" + str(i + 1) + ": " + groups[i].get_name())
+    return groups
@@ -0,0 +1,180 @@
+import os
+import threading
+from collections import OrderedDict
+
+from MACARON_Utils.DICOMType import DICOMType
+
+# Default memory budget (bytes) of the process-wide pool of FileDataset objects
+DEFAULT_POOL_BUDGET = 2 * 1024 ** 3
+
+
+class DICOMPool:
+    """
+    Process-wide LRU pool of FileDataset objects, bounded by a memory budget.
+    Datasets are keyed by file path, checked against the modification time of the file, and their size is
+    estimated from the size of the file. Pinned datasets count against the budget but are never evicted
+    """
+
+    def __init__(self, budget=DEFAULT_POOL_BUDGET):
+        """
+        Constructor for DICOMPool
+        :param budget: the maximum amount of bytes of the datasets in the pool
+        """
+        self.budget = budget
+        self.used = 0
+        self.datasets = OrderedDict()
+        self.pinned = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def get_mtime(file_name):
+        """
+        Gets the modification time of a file, used to detect datasets that are no longer valid
+        :param file_name: the path to the DICOM file
+        :return: the modification time, or None if the file cannot be accessed
+        """
+        try:
+            return os.path.getmtime(file_name)
+        except OSError:
+            return None
+
+    def get(self, file_name):
+        """
+        Gets a FileDataset from the pool, marking it as the most recently used
+        :param file_name: the path to the DICOM file
+        :return: the FileDataset, or None if it is not in the pool or the file changed since it was read
+        """
+        mtime = self.get_mtime(file_name)
+        with self.lock:
+            if file_name in self.datasets:
+                ob_mtime, dicom_ob, size = self.datasets[file_name]
+                if ob_mtime == mtime:
+                    self.datasets.move_to_end(file_name)
+                    return dicom_ob
+                self.release(file_name)
+        return None
+
+    def put(self, file_name, dicom_ob):
+        """
+        Adds a FileDataset to the pool, evicting the least recently used datasets if the budget is exceeded
+        :param file_name: the path to the DICOM file the dataset was read from
+        :param dicom_ob: the FileDataset object
+        """
+        mtime = self.get_mtime(file_name)
+        if mtime is None:
+            return
+        size = os.path.getsize(file_name)
+        with self.lock:
+            self.release(file_name)
+            self.datasets[file_name] = (mtime, dicom_ob, size)
+            self.used += size
+            self.evict(keep=1)
+
+    def release(self, file_name):
+        """
+        Removes the dataset read from a file from the pool
+        :param file_name: the path to the DICOM file
+        """
+        with self.lock:
+            if file_name in self.datasets:
+                self.used -= self.datasets.pop(file_name)[2]
+
+    def evict(self, keep=0):
+        """
+        Evicts the least recently used datasets until the pool fits its budget
+        :param keep: the number of most recently used datasets that cannot be evicted
+        """
+        with self.lock:
+            for file_name in list(self.datasets.keys())[:max(len(self.datasets) - keep, 0)]:
+                if self.used <= self.budget:
+                    break
+                if file_name not in self.pinned:
+                    self.release(file_name)
+
+    def pin(self, file_name):
+        """
+        Prevents the dataset read from a file from being evicted, until it is unpinned as many times as it was pinned
+        :param file_name: the path to the DICOM file
+        """
+        with self.lock:
+            self.pinned[file_name] = self.pinned.get(file_name, 0) + 1
+
+    def unpin(self, file_name):
+        """
+        Allows the dataset read from a file to be evicted again, evicting datasets if the pool exceeds its budget
+        :param file_name: the path to the DICOM file
+        """
+        with self.lock:
+            if file_name in self.pinned:
+                self.pinned[file_name] -= 1
+                if self.pinned[file_name] == 0:
+                    del self.pinned[file_name]
+            self.evict()
+
+    def clear(self):
+        """
+        Removes all datasets from the pool
+        """
+        with self.lock:
+            self.datasets.clear()
+            self.used = 0
+
+    def set_budget(self, budget):
+        """
+        Sets the memory budget of the pool, evicting datasets if needed
+        :param budget: the maximum amount of bytes of the datasets in the pool
+        """
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+
+class DatasetCache:
+    """
+    Cache of the parsed FileDataset objects used by the studies of a DICOMGroup, backed by the DICOM_POOL so that
+    it stays within its memory budget. RT datasets (RT_STRUCT, RT_PLAN, RT_DOSE), which are parsed by many studies
+    of the group, are pinned in the pool until the cache is cleared; CT slices may be evicted and re-read on demand
+    """
+
+    def __init__(self):
+        """
+        Constructor for DatasetCache
+        """
+        self.pinned = set()
+        self.lock = threading.Lock()
+
+    def get(self, dicom_object):
+        """
+        Gets the FileDataset of a DICOMObject from the DICOM_POOL, loading it if it is not in the pool
+        :param dicom_object: the DICOMObject
+        :return: the FileDataset object
+        """
+        dicom_ob = dicom_object.get_object()
+        file_name = dicom_object.get_file_name()
+        if dicom_object.get_type() is not DICOMType.TC:
+            with self.lock:
+                if file_name not in self.pinned:
+                    DICOM_POOL.pin(file_name)
+                    self.pinned.add(file_name)
+        return dicom_ob
+
+    def clear(self):
+        """
+        Unpins the datasets of the cache, leaving them to the DICOM_POOL
+        """
+        with self.lock:
+            for file_name in self.pinned:
+                DICOM_POOL.unpin(file_name)
+            self.pinned.clear()
+
+
+# The pool shared by all DICOMObjects of the process
+DICOM_POOL = DICOMPool()
+
+
+def set_pool_budget(budget):
+    """
+    Sets the memory budget of the process-wide pool of FileDataset objects
+    :param budget: the maximum amount of bytes of the datasets in the pool
+    """
+    DICOM_POOL.set_budget(budget)
@@ -0,0 +1,171 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from MACARON_Utils.DICOMObject import DICOMObject
+from MACARON_Utils.DICOM_Group import DICOMGroup
+from MACARON_Utils.DICOM_utils import load_DICOM_header, sanitize_DICOM
+
+# Extensions of the files that are read as DICOM by the scanner
+DICOM_EXTENSIONS = ("dcm", "DCM", "dicom", "DICOM")
+
+# Extensions of the files that are assigned to a DICOMGroup as isodose files
+NRRD_EXTENSIONS = ("nrrd", "NRRD")
+
+# Default number of threads reading DICOM headers
+DEFAULT_SCAN_WORKERS = 8
+
+
+def walk_DICOM_folders(main_folder):
+    """
+    Walks a folder tree with os.scandir, listing DICOM and NRRD files of each folder.
+    Folders are visited depth-first, each one before its subfolders
+    :param main_folder: root folder
+    :return: a generator of (folder, dicom_files, nrrd_files) tuples
+    """
+    stack = [main_folder]
+    while len(stack) > 0:
+        folder = stack.pop()
+        dicom_files = []
+        nrrd_files = []
+        subfolders = []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subfolders.append(folder + "/" + entry.name)
+                    elif entry.name.endswith(DICOM_EXTENSIONS):
+                        dicom_files.append(folder + "/" + entry.name)
+                    elif entry.name.endswith(NRRD_EXTENSIONS):
+                        nrrd_files.append(folder + "/" + entry.name)
+        except OSError as e:
+            print("Unable to scan folder '" + folder + "': " + str(e))
+            continue
+        yield folder, sorted(dicom_files), sorted(nrrd_files)
+        stack.extend(sorted(subfolders, reverse=True))
+
+
+def build_DICOM_group(folder, tmp_folder, headers, nrrd_files):
+    """
+    Builds a DICOMGroup from the headers read from the DICOM files of a folder
+    :param folder: the folder of the DICOMGroup
+    :param tmp_folder: the folder for temporary files of the DICOMGroup
+    :param headers: a list of (dicom_file, future) tuples, where each future reads the header of the file
+    :param nrrd_files: NRRD files in the folder
+    :return: the DICOMGroup, or None if the folder does not contain any DICOM object
+    """
+    dg = DICOMGroup(dicom_folder=folder,
+                    group_name=folder.split('/')[-1] if "/" in folder else folder,
+                    tmp_folder=tmp_folder)
+    for dicom_file, header in headers:
+        try:
+            f_ob, f_type = header.result()
+        except Exception as e:
+            print("Unable to read file '" + dicom_file + "': " + str(e))
+            continue
+        dg.add_DICOM_object(DICOMObject(dicom_file, f_ob, f_type, header_only=True))
+    for nrrd_file in nrrd_files:
+        dg.isodose_file = nrrd_file
+    return dg if dg.has_DICOM_objects() else None
+
+
+def scan_DICOM_groups(main_folder, tmp_folder, workers=DEFAULT_SCAN_WORKERS, max_pending=64, catalog=None):
+    """
+    Scans a folder tree for DICOM groups (one per folder), reading headers on a thread pool.
+    The tree is walked in a background thread, and each DICOMGroup is yielded as soon as all of its files are read
+    :param main_folder: root folder
+    :param tmp_folder: the folder for temporary files of the DICOMGroups
+    :param workers: number of threads reading DICOM headers
+    :param max_pending: maximum number of folders that are walked ahead of the last yielded DICOMGroup
+    :param catalog: a DICOMCatalog to skip reading headers of unchanged files
+    :return: a generator of DICOMGroup objects, in walking order
+    """
+    pending = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    load_header = catalog.load_header if catalog is not None else load_DICOM_header
+
+    def walk(executor):
+        try:
+            for folder, dicom_files, nrrd_files in walk_DICOM_folders(main_folder):
+                if stop.is_set():
+                    break
+                headers = [(dicom_file, executor.submit(load_header, dicom_file)) for dicom_file in dicom_files]
+                pending.put((folder, headers, nrrd_files))
+        finally:
+            pending.put(None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        walker = threading.Thread(target=walk, args=(executor,), daemon=True)
+        walker.start()
+        found = 0
+        try:
+            item = pending.get()
+            while item is not None:
+                dg = build_DICOM_group(item[0], tmp_folder, item[1], item[2])
+                if dg is not None:
+                    found += 1
+                    print("Found Patient #" + str(found) + ": " + dg.get_name())
+                    yield dg
+                item = pending.get()
+        finally:
+            stop.set()
+            # Drains the queue so that the walker is not blocked on a full queue
+            while walker.is_alive():
+                try:
+                    item = pending.get(timeout=0.1)
+                    if item is not None:
+                        for dicom_file, header in item[1]:
+                            header.cancel()
+                except queue.Empty:
+                    pass
+            if catalog is not None:
+                catalog.commit()
+
+
+def find_DICOM_groups(main_folder, tmp_folder, workers=DEFAULT_SCAN_WORKERS, catalog=None):
+    """
+    Returns an array of dicom groups in the main folder
+    @param main_folder: root folder
+    @param tmp_folder: the folder for temporary files of the DICOMGroups
+    @param workers: number of threads reading DICOM headers
+    @param catalog: a DICOMCatalog to skip reading headers of unchanged files
+    @return: array of dicom groups
+    """
+    return list(scan_DICOM_groups(main_folder, tmp_folder, workers, catalog=catalog))
+
+
+def iterate_cohort(main_folder, tmp_folder, studies, output_folder=None, workers=DEFAULT_SCAN_WORKERS,
+                   catalog=None):
+    """
+    Iterates over the DICOM groups of a folder tree, running a list of studies on each group and releasing the
+    datasets, caches and results of the group before moving to the next one. Peak memory is then bound by a single
+    group rather than by the size of the cohort
+    @param main_folder: root folder
+    @param tmp_folder: the folder for temporary files of the DICOMGroups
+    @param studies: a list of DICOMStudy objects
+    @param output_folder: if not None, the folder where each group reports its studies as files
+    @param workers: number of threads reading DICOM headers
+    @param catalog: a DICOMCatalog to skip reading headers of unchanged files
+    @return: a generator of (DICOMGroup, results) tuples, where results are those of DICOMGroup.run_studies. The
+             DICOMGroup is closed when the next tuple is requested
+    """
+    for dg in scan_DICOM_groups(main_folder, tmp_folder, workers, catalog=catalog):
+        with dg:
+            if output_folder is not None:
+                dg.report(studies=studies, output_folder=output_folder)
+            yield dg, dg.run_studies(studies)
+
+
+def sanitize_DICOM_archive(main_folder, workers=None):
+    """
+    Adds the TransferSyntaxUID parameter to all the DICOM files of a folder tree that miss it, once and ahead of
+    time, using a pool of processes. DICOM files are updated in place
+    @param main_folder: root folder
+    @param workers: number of processes, defaults to the number of CPUs
+    @return: the number of updated files
+    """
+    dicom_files = (dicom_file for folder, folder_files, nrrd_files in walk_DICOM_folders(main_folder)
+                   for dicom_file in folder_files)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum(1 for updated in executor.map(sanitize_DICOM, dicom_files, chunksize=16) if updated)
@@ -1,8 +1,13 @@
+import numpy
 import pydicom
 from dicompylercore import dicomparser, dvhcalc
 
 from MACARON_Utils.DICOMType import DICOMType
 
+# Tags that are read when classifying a DICOM file without loading it in full
+HEADER_TAGS = ["SOPClassUID", "SOPInstanceUID", "PatientName", "StudyInstanceUID", "FrameOfReferenceUID",
+               "ReferencedRTPlanSequence", "ReferencedStructureSetSequence", "ReferencedFrameOfReferenceSequence"]
+
 
 def load_DICOM(file_path, sanitize=True):
     """
@@ -12,23 +17,93 @@ def load_DICOM(file_path, sanitize=True):
     :return: the DICOMObject and its DICOMType
     """
     dicom_ob = pydicom.read_file(file_path, force=True)
-    if sanitize and ("TransferSyntaxUID" not in dicom_ob.file_meta):
-        sanitize_DICOM(file_path)
-        dicom_ob = pydicom.read_file(file_path, force=True)
+    if sanitize:
+        sanitize_DICOM_object(dicom_ob)
     dicom_type = get_DICOM_type_from_object(dicom_ob)
     return dicom_ob, dicom_type
 
 
+def load_DICOM_header(file_path, sanitize=True):
+    """
+    Loads only the file meta and the HEADER_TAGS of a DICOM file, skipping pixel data and all other elements
+    :param file_path: path to the DICOM file
+    :param sanitize: True if a TransferSyntaxUID field may be missing from the DICOM file
+    :return: the (partial) FileDataset and its DICOMType
+    """
+    dicom_header = pydicom.read_file(file_path, force=True, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    if sanitize:
+        sanitize_DICOM_object(dicom_header)
+    dicom_type = get_DICOM_type_from_object(dicom_header)
+    return dicom_header, dicom_type
+
+
+def extract_DICOM_header(dicom_ob):
+    """
+    Builds a lightweight copy of a FileDataset that contains only its file meta and the HEADER_TAGS
+    :param dicom_ob: the FileDataset object
+    :return: the (partial) Dataset object
+    """
+    dicom_header = pydicom.Dataset()
+    dicom_header.file_meta = dicom_ob.file_meta
+    for tag in HEADER_TAGS:
+        if tag in dicom_ob:
+            setattr(dicom_header, tag, getattr(dicom_ob, tag))
+    return dicom_header
+
+
+def get_frame_of_reference(dicom_header):
+    """
+    Gets the FrameOfReferenceUID of a DICOM, using the ReferencedFrameOfReferenceSequence for RT_STRUCT files
+    :param dicom_header: the Dataset object
+    :return: the FrameOfReferenceUID string, or None if it is missing
+    """
+    if "FrameOfReferenceUID" in dicom_header:
+        return str(dicom_header.FrameOfReferenceUID)
+    ref_sequence = getattr(dicom_header, "ReferencedFrameOfReferenceSequence", None)
+    if ref_sequence is not None and len(ref_sequence) > 0 and "FrameOfReferenceUID" in ref_sequence[0]:
+        return str(ref_sequence[0].FrameOfReferenceUID)
+    return None
+
+
+def get_referenced_UIDs(dicom_header, sequence_tag):
+    """
+    Gets the ReferencedSOPInstanceUID values of the items of a sequence
+    :param dicom_header: the Dataset object
+    :param sequence_tag: the keyword of the sequence (e.g. ReferencedRTPlanSequence)
+    :return: a list of UID strings
+    """
+    ref_sequence = getattr(dicom_header, sequence_tag, None)
+    if ref_sequence is None:
+        return []
+    return [str(item.ReferencedSOPInstanceUID) for item in ref_sequence if "ReferencedSOPInstanceUID" in item]
+
+
+def sanitize_DICOM_object(dicom_ob):
+    """
+    Adds a TransferSyntaxUID parameter (default value) to a FileDataset in memory, without modifying its file
+    :param dicom_ob: the FileDataset to sanitize
+    :return: True if the FileDataset was missing the TransferSyntaxUID
+    """
+    if "TransferSyntaxUID" not in dicom_ob.file_meta:
+        dicom_ob.file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
+        return True
+    return False
+
+
 def sanitize_DICOM(file_path):
     """
     Updates a DICOM file by adding a TransferSyntaxUID parameter (default value)
     :param file_path: file to sanitize
+    :return: True if the file was updated
     """
-    ds = pydicom.read_file(file_path, force=True)
+    ds = pydicom.read_file(file_path, force=True, stop_before_pixels=True, specific_tags=["SOPClassUID"])
     if "TransferSyntaxUID" not in ds.file_meta:
-        ds.file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
-        print("Adding parameter 'TransferSyntaxUID' to DICOM")
+        ds = pydicom.read_file(file_path, force=True)
+        sanitize_DICOM_object(ds)
+        print("Adding parameter 'TransferSyntaxUID' to DICOM '" + file_path + "'")
         pydicom.write_file(file_path, ds)
+        return True
+    return False
 
 
 def extractPatientData(dicom_ob):
@@ -159,7 +234,7 @@ def get_DICOM_type_from_ID(uid):
 def get_structures(rts_file):
     """
     Extract structures from an RT_STRUCTURE DICOM file
-    :param rts_file: the path to the RT_STRUCTURE file
+    :param rts_file: the path to the RT_STRUCTURE file, or its already parsed FileDataset
     :return: a dictionary with structures
     """
     rtss = dicomparser.DicomParser(rts_file)
@@ -173,7 +248,7 @@ def get_structures(rts_file):
 def get_plan(rtp_file):
     """
     Gets the plan from an RT_PLAN DICOM object
-    :param rtp_file: the path to the RT_PLAN file
+    :param rtp_file: the path to the RT_PLAN file, or its already parsed FileDataset
     :return: a dictionary with the plan, and a string description
     """
     rtp = dicomparser.DicomParser(rtp_file)
@@ -185,28 +260,53 @@ def get_plan(rtp_file):
         return {}, {}
 
 
-def build_DVH_info(dvh):
-    dvh_info = {}
-    dvh_info["Structure"] = dvh.name
+def build_DVH_record(dvh):
+    """
+    Builds the record of a DVH, with counts and bins as float32 numpy arrays and scalar statistics as floats
+    :param dvh: the dicompylercore DVH object
+    :return: a dictionary with the data of the DVH
+    """
+    dvh_record = {}
+    dvh_record["Structure"] = dvh.name
     if dvh.volume_units == '%':
-        dvh_info["rel volume"] = dvh.volume
+        dvh_record["rel volume"] = float(dvh.volume)
     else:
-        dvh_info["abs volume"] = dvh.volume
-    dvh_info["type"] = dvh.dvh_type
-    dvh_info["volume unit"] = dvh.volume_units
-    dvh_info["dose unit"] = dvh.dose_units
-    dvh_info["Max Dose"] = dvh.max
-    dvh_info["Min Dose"] = dvh.min
-    dvh_info["Mean Dose"] = dvh.mean
-    dvh_info["D100"] = dvh.D100
-    dvh_info["D98"] = dvh.D98
-    dvh_info["D95"] = dvh.D95
+        dvh_record["abs volume"] = float(dvh.volume)
+    dvh_record["type"] = dvh.dvh_type
+    dvh_record["volume unit"] = dvh.volume_units
+    dvh_record["dose unit"] = dvh.dose_units
+    dvh_record["Max Dose"] = float(dvh.max)
+    dvh_record["Min Dose"] = float(dvh.min)
+    dvh_record["Mean Dose"] = float(dvh.mean)
+    dvh_record["D100"] = float(dvh.D100.value)
+    dvh_record["D98"] = float(dvh.D98.value)
+    dvh_record["D95"] = float(dvh.D95.value)
     if dvh.dose_units == '%':
-        dvh_info["V100"] = dvh.V100
-        dvh_info["V95"] = dvh.V95
-        dvh_info["V5"] = dvh.V5
-    dvh_info["D2cc"] = dvh.D2cc
-    dvh_info["counts"] = ",".join([str(a) for a in dvh.counts])
-    dvh_info["bins"] = ",".join([str(a) for a in dvh.bins])
-    #dvh_info["cumulative"] = dvh.cumulative
+        dvh_record["V100"] = float(dvh.V100.value)
+        dvh_record["V95"] = float(dvh.V95.value)
+        dvh_record["V5"] = float(dvh.V5.value)
+    dvh_record["D2cc"] = float(dvh.D2cc.value)
+    dvh_record["counts"] = numpy.asarray(dvh.counts, dtype=numpy.float32)
+    dvh_record["bins"] = numpy.asarray(dvh.bins, dtype=numpy.float32)
+    return dvh_record
+
+
+def format_DVH_record(dvh_record):
+    """
+    Converts a DVH record into a human-readable dictionary, where counts and bins are comma-joined strings
+    :param dvh_record: the dictionary built by build_DVH_record
+    :return: a dictionary with the data of the DVH
+    """
+    dvh_info = dict(dvh_record)
+    dvh_info["counts"] = ",".join([str(a) for a in dvh_record["counts"].tolist()])
+    dvh_info["bins"] = ",".join([str(a) for a in dvh_record["bins"].tolist()])
     return dvh_info
+
+
+def build_DVH_info(dvh):
+    """
+    Builds a human-readable dictionary with the data of a DVH, see format_DVH_record
+    :param dvh: the dicompylercore DVH object
+    :return: a dictionary with the data of the DVH
+    """
+    return format_DVH_record(build_DVH_record(dvh))
@@ -0,0 +1,10 @@
+from enum import Enum
+
+
+class DVHPolicy(Enum):
+    """
+    Enum variable that contains the policies for using the DVHs embedded in the DVHSequence of RT_DOSE files
+    """
+    PREFER_EMBEDDED = 1
+    ALWAYS_COMPUTE = 2
+    VERIFY_SAMPLE = 3
@@ -0,0 +1,11 @@
+from enum import Enum
+
+
+class RadiomicsProfile(Enum):
+    """
+    Enum variable that contains the profiles of radiomic features extracted for each structure, by name
+    """
+    SHAPE_ONLY = "shape-only"
+    FIRST_ORDER = "first-order"
+    DB_SCHEMA = "db-schema"
+    FULL = "full"
@@ -0,0 +1,147 @@
+import numpy
+from dicompylercore import dvh
+
+# Dx metrics: minimum dose received by the hottest x% of the volume of a structure
+DEFAULT_D_METRICS = [100, 98, 95]
+
+# Dxcc metrics: minimum dose received by the hottest x cm3 of a structure
+DEFAULT_CC_METRICS = [2]
+
+# Vx metrics: percentage of the volume of a structure receiving at least x% of the prescription dose
+DEFAULT_V_METRICS = [100, 95, 5]
+
+
+def sort_voxel_doses(doses, volumes):
+    """
+    Sorts the voxels of a structure by decreasing dose, accumulating their volume
+    :param doses: the dose of each voxel
+    :param volumes: the volume of each voxel
+    :return: the sorted doses, and the volume receiving at least each of the sorted doses
+    """
+    order = numpy.argsort(doses, kind="stable")[::-1]
+    return doses[order], numpy.cumsum(volumes[order], dtype=numpy.float64)
+
+
+def get_dose_at_volume(sorted_doses, cum_volumes, volume):
+    """
+    Gets the minimum dose received by the hottest part of a structure
+    :param sorted_doses: the doses of the voxels, sorted by decreasing dose
+    :param cum_volumes: the volume receiving at least each of the sorted doses
+    :param volume: the volume of the hottest part of the structure
+    :return: the dose, 0 if the structure is smaller than the volume
+    """
+    if len(cum_volumes) == 0 or volume > cum_volumes[-1]:
+        return 0.0
+    return float(sorted_doses[numpy.searchsorted(cum_volumes, volume)])
+
+
+def get_volume_at_dose(sorted_doses, cum_volumes, dose):
+    """
+    Gets the volume of a structure receiving at least a dose
+    :param sorted_doses: the doses of the voxels, sorted by decreasing dose
+    :param cum_volumes: the volume receiving at least each of the sorted doses
+    :param dose: the dose
+    :return: the volume
+    """
+    count = numpy.searchsorted(-sorted_doses, -dose, side="right")
+    return float(cum_volumes[count - 1]) if count > 0 else 0.0
+
+
+def calculate_dose_metrics(name, doses, volumes, rx_dose=None, d_metrics=DEFAULT_D_METRICS,
+                           cc_metrics=DEFAULT_CC_METRICS, v_metrics=DEFAULT_V_METRICS):
+    """
+    Calculates the scalar DVH metrics of a structure from the dose and volume of its voxels, in a single sort and
+    cumulative sum, without building its DVH. Metrics have the same keys as DICOM_utils.build_DVH_record
+    :param name: the name of the structure
+    :param doses: the dose of each voxel, in cGy
+    :param volumes: the volume of each voxel, in cm3
+    :param rx_dose: the prescription dose in cGy, Vx metrics are computed only if it is given
+    :param d_metrics: the percentages of volume of the Dx metrics
+    :param cc_metrics: the volumes in cm3 of the Dxcc metrics
+    :param v_metrics: the percentages of the prescription dose of the Vx metrics
+    :return: a dictionary with the metrics, with doses in Gy
+    """
+    sorted_doses, cum_volumes = sort_voxel_doses(doses, volumes)
+    total_volume = float(cum_volumes[-1]) if len(cum_volumes) > 0 else 0.0
+    metrics = {"Structure": name, "abs volume": total_volume, "volume unit": "cm3", "dose unit": "gy"}
+    if len(sorted_doses) > 0:
+        metrics["Max Dose"] = float(sorted_doses[0]) / 100
+        metrics["Min Dose"] = float(sorted_doses[-1]) / 100
+        metrics["Mean Dose"] = float(numpy.dot(sorted_doses, numpy.diff(cum_volumes, prepend=0))) / total_volume / 100
+    else:
+        metrics["Max Dose"] = metrics["Min Dose"] = metrics["Mean Dose"] = 0.0
+    for d in d_metrics:
+        metrics["D" + str(d)] = get_dose_at_volume(sorted_doses, cum_volumes, total_volume * d / 100) / 100
+    for cc in cc_metrics:
+        metrics["D" + str(cc) + "cc"] = get_dose_at_volume(sorted_doses, cum_volumes, cc) / 100
+    if rx_dose is not None and rx_dose > 0:
+        for v in v_metrics:
+            metrics["V" + str(v)] = get_volume_at_dose(sorted_doses, cum_volumes, rx_dose * v / 100) * 100 / \
+                                    total_volume if total_volume > 0 else 0.0
+    return metrics
+
+
+def convert_to_EQD2(doses, fractions, alpha_beta):
+    """
+    Converts physical doses to the equivalent dose in 2 Gy fractions (EQD2) with the linear-quadratic model
+    :param doses: the total dose of each voxel, in cGy
+    :param fractions: the number of fractions
+    :param alpha_beta: the alpha/beta ratio of the tissue, in Gy
+    :return: the EQD2 of each voxel, in cGy
+    """
+    doses = numpy.asarray(doses, dtype=numpy.float64)
+    return (doses * (doses / fractions + alpha_beta * 100) / (200 + alpha_beta * 100)).astype(numpy.float32)
+
+
+def calculate_gEUD(doses, volumes, a):
+    """
+    Calculates the generalized equivalent uniform dose (gEUD) of a structure
+    :param doses: the dose of each voxel, in cGy
+    :param volumes: the volume of each voxel, in cm3
+    :param a: the volume-effect parameter of the tissue (a = 1 gives the mean dose)
+    :return: the gEUD in Gy, 0 if the structure is empty
+    """
+    total_volume = numpy.sum(volumes, dtype=numpy.float64)
+    if total_volume == 0:
+        return 0.0
+    weighted = numpy.dot(volumes.astype(numpy.float64), numpy.power(doses.astype(numpy.float64), a))
+    return float(numpy.power(weighted / total_volume, 1.0 / a)) / 100
+
+
+def calculate_subvolume_mean_dose(doses, volumes, percentage, hottest=True):
+    """
+    Calculates the mean dose of the hottest (or coldest) part of a structure
+    :param doses: the dose of each voxel, in cGy
+    :param volumes: the volume of each voxel, in cm3
+    :param percentage: the percentage of the volume of the structure in the sub-volume
+    :param hottest: True for the hottest part of the structure, False for the coldest one
+    :return: the mean dose in Gy, 0 if the structure is empty
+    """
+    if hottest:
+        sorted_doses, cum_volumes = sort_voxel_doses(doses, volumes)
+    else:
+        order = numpy.argsort(doses, kind="stable")
+        sorted_doses, cum_volumes = doses[order], numpy.cumsum(volumes[order], dtype=numpy.float64)
+    if len(cum_volumes) == 0 or percentage <= 0:
+        return 0.0
+    sub_volume = cum_volumes[-1] * min(percentage, 100) / 100
+    # The voxel at the boundary of the sub-volume is included only in part
+    count = numpy.searchsorted(cum_volumes, sub_volume)
+    partial = numpy.diff(cum_volumes[:count + 1], prepend=0)
+    partial[-1] = sub_volume - (cum_volumes[count - 1] if count > 0 else 0)
+    return float(numpy.dot(sorted_doses[:count + 1], partial) / sub_volume) / 100
+
+
+def build_DVH(name, doses, volumes, bin_width=1):
+    """
+    Builds the cumulative DVH of a structure from the dose and volume of its voxels
+    :param name: the name of the structure
+    :param doses: the dose of each voxel, in cGy
+    :param volumes: the volume of each voxel, in cm3
+    :param bin_width: width of the dose bins in cGy
+    :return: the dicompylercore DVH object, with doses in Gy
+    """
+    counts = numpy.bincount(numpy.floor(doses / bin_width).astype(numpy.int64), weights=volumes) \
+        if len(doses) > 0 else numpy.array([0.0])
+    return dvh.DVH(counts=counts, bins=numpy.arange(0, len(counts) + 1) * bin_width / 100,
+                   dvh_type="differential", dose_units="gy", name=name).cumulative
@@ -0,0 +1,48 @@
+import SimpleITK
+import numpy
+
+from MACARON_Utils.CT_volume import get_slice_normal, get_tmp_volume_file, commit_volume, load_CT_volume
+from MACARON_Utils.mask_source import get_image_geometry
+
+
+def get_dose_grid_image(rtdose):
+    """
+    Builds a SimpleITK image from the dose grid of a RT_DOSE, on its own grid
+    :param rtdose: the FileDataset of the RT_DOSE
+    :return: the SimpleITK Image with the dose in Gy (float32), with frames sorted along the normal to the frames
+    """
+    row_dir, col_dir, normal = get_slice_normal(rtdose)
+    pixel_array = rtdose.pixel_array.reshape((-1, int(rtdose.Rows), int(rtdose.Columns)))
+    # GridFrameOffsetVector may be relative to the first frame or absolute, both give the same offsets once shifted
+    offsets = numpy.array(getattr(rtdose, "GridFrameOffsetVector", [0.0]), dtype=float)[:len(pixel_array)]
+    offsets = offsets - offsets[0]
+    order = numpy.argsort(offsets, kind="stable")
+    volume = (pixel_array[order] * float(rtdose.DoseGridScaling)).astype(numpy.float32)
+    image = SimpleITK.GetImageFromArray(volume)
+    z_spacing = float(numpy.median(numpy.diff(offsets[order]))) if len(offsets) > 1 \
+        else float(getattr(rtdose, "SliceThickness", 1.0) or 1.0)
+    image.SetSpacing([float(rtdose.PixelSpacing[1]), float(rtdose.PixelSpacing[0]), z_spacing])
+    image.SetOrigin([float(x) for x in numpy.array(rtdose.ImagePositionPatient, dtype=float) +
+                     offsets[order[0]] * normal])
+    image.SetDirection([float(x) for x in numpy.stack([row_dir, col_dir, normal], axis=1).flatten()])
+    return image
+
+
+def build_dose_volume(rtdose, reference, npy_file, source=None):
+    """
+    Resamples the dose grid of a RT_DOSE on the grid of a reference image (e.g. the CT) and stores it as a
+    memory-mapped .npy file, with a .json sidecar file containing its geometry, as CT_volume.build_CT_volume
+    :param rtdose: the FileDataset of the RT_DOSE
+    :param reference: the SimpleITK Image whose grid the dose is resampled on, linearly and with 0 outside the grid
+    :param npy_file: the path to the .npy file to write
+    :param source: a (JSON serializable) signature of the source files, stored in the geometry dictionary
+    :return: the memory-mapped volume (z, y, x) and its geometry dictionary
+    """
+    image = SimpleITK.Resample(get_dose_grid_image(rtdose), reference, SimpleITK.Transform(), SimpleITK.sitkLinear,
+                               0.0, SimpleITK.sitkFloat32)
+    geometry = get_image_geometry(image)
+    geometry["source"] = source
+    tmp_npy_file = get_tmp_volume_file(npy_file)
+    numpy.save(tmp_npy_file, SimpleITK.GetArrayViewFromImage(image))
+    commit_volume(tmp_npy_file, geometry, npy_file)
+    return load_CT_volume(npy_file)
@@ -107,6 +107,16 @@ def create_masks_NRRD(tmp_folder, rt_struct_filename, rt_dose_filename, name, ct
               "needs to be installed and available in the PATH for using this converter script.")
 
 
+def create_ss_NRRD(tmp_folder, rt_struct_filename, name, ct_nrrd_filename):
+    if distutils.spawn.find_executable('plastimatch') is not None:
+        call(['plastimatch', 'convert', '--input', rt_struct_filename,
+              '--output-ss-img', tmp_folder + "/" + name + '_ss.nrrd',
+              '--output-ss-list', tmp_folder + "/" + name + '_ss.txt', '--fixed', ct_nrrd_filename])
+    else:
+        print("Dependency converter(s) not found in the path.\n Plastimatch (http://plastimatch.org/) "
+              "needs to be installed and available in the PATH for using this converter script.")
+
+
 def process_mask_NRRD(mask_NRRD_file):
     ma = SimpleITK.ReadImage(mask_NRRD_file)
     ma_arr = SimpleITK.GetArrayFromImage(ma)
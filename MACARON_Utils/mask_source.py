@@ -0,0 +1,267 @@
+import SimpleITK
+import numpy
+
+from MACARON_Utils.CT_volume import get_CT_image
+
+# Margin, in voxels, around the bounding box of the structures when cropping masks and images (the same as the
+# default padDistance of pyradiomics)
+DEFAULT_MASK_PADDING = 5
+
+
+def read_ss_list(ss_list_file):
+    """
+    Reads the list of structures written by plastimatch convert --output-ss-list. The bit of each structure in the
+    structure set image is the index written at the start of its line, not its position in the list, so the
+    dictionary can be reordered freely. Structures sharing the same name are told apart by appending their bit
+    :param ss_list_file: the path to the list, with lines formatted as 'bit|color|name'
+    :return: a dictionary with the bit of each structure in the structure set image, indexed by structure name
+    """
+    entries = []
+    with open(ss_list_file, 'r') as f:
+        for line in f:
+            fields = line.strip().split("|", 2)
+            if len(fields) == 3 and fields[0].isdigit():
+                entries.append((int(fields[0]), fields[2]))
+    names = set(name for bit, name in entries)
+    bits = {}
+    for bit, name in entries:
+        if name in bits:
+            # The name given to a duplicate must not clash with any other structure, e.g. a real 'PTV_3'
+            unique_name = name + "_" + str(bit)
+            suffix = 1
+            while unique_name in names or unique_name in bits:
+                unique_name = name + "_" + str(bit) + "_" + str(suffix)
+                suffix += 1
+            name = unique_name
+        bits[name] = bit
+    return bits
+
+
+def read_ss_image(ss_image_file):
+    """
+    Reads the structure set image written by plastimatch convert --output-ss-img, where each bit of a voxel tells if
+    the voxel is inside a structure. Plastimatch writes a scalar (e.g. uint32) image for small structure sets, and a
+    vector uint8 image, with 8 bits per channel, for larger ones
+    :param ss_image_file: the path to the image
+    :return: the bits of the voxels packed as unsigned words (words, z, y, x), in the native word type of a scalar
+             image and as uint64 words for a vector image, and the geometry of the image
+    """
+    image = SimpleITK.ReadImage(ss_image_file)
+    if image.GetNumberOfComponentsPerPixel() > 1:
+        ss_arr = SimpleITK.GetArrayViewFromImage(image)
+        words = numpy.zeros(((ss_arr.shape[3] + 7) // 8,) + ss_arr.shape[:3], dtype=numpy.uint64)
+        for channel in range(ss_arr.shape[3]):
+            words[channel // 8] |= ss_arr[..., channel].astype(numpy.uint64) << numpy.uint64(8 * (channel % 8))
+    else:
+        ss_arr = SimpleITK.GetArrayFromImage(image)
+        words = ss_arr.view("u" + str(ss_arr.dtype.itemsize))[numpy.newaxis]
+    return words, get_image_geometry(image)
+
+
+def get_image_geometry(image):
+    """
+    Gets the geometry of a SimpleITK image
+    :param image: the SimpleITK Image
+    :return: a dictionary with shape (z, y, x), spacing, origin and direction, as in CT_volume.get_CT_geometry
+    """
+    return {"shape": list(reversed(image.GetSize())),
+            "spacing": list(image.GetSpacing()),
+            "origin": list(image.GetOrigin()),
+            "direction": list(image.GetDirection())}
+
+
+def expand_mask(view, offset, shape):
+    """
+    Expands the cropped mask of a structure to the full grid
+    :param view: the cropped (z, y, x) boolean mask
+    :param offset: the (z, y, x) index of the first voxel of the cropped mask in the grid
+    :param shape: the (z, y, x) shape of the grid
+    :return: the boolean mask on the full grid
+    """
+    mask = numpy.zeros(shape, dtype=bool)
+    mask[tuple(slice(o, o + s) for o, s in zip(offset, view.shape))] = view
+    return mask
+
+
+def get_block_geometry(geometry, offset, shape):
+    """
+    Gets the geometry of a block of a grid
+    :param geometry: the geometry dictionary of the grid
+    :param offset: the (z, y, x) index of the first voxel of the block in the grid
+    :param shape: the (z, y, x) shape of the block
+    :return: the geometry dictionary of the block
+    """
+    direction = numpy.array(geometry["direction"]).reshape(3, 3)
+    shift = direction.dot(numpy.array(geometry["spacing"]) * numpy.array(offset[::-1]))
+    return {"shape": list(shape),
+            "spacing": list(geometry["spacing"]),
+            "origin": [float(x) for x in numpy.array(geometry["origin"]) + shift],
+            "direction": list(geometry["direction"])}
+
+
+def crop_image(image, offset, shape):
+    """
+    Crops a SimpleITK image to a block of its grid, keeping its physical position
+    :param image: the SimpleITK Image
+    :param offset: the (z, y, x) index of the first voxel of the block in the grid
+    :param shape: the (z, y, x) shape of the block
+    :return: the cropped SimpleITK Image
+    """
+    return image[offset[2]:offset[2] + shape[2], offset[1]:offset[1] + shape[1], offset[0]:offset[0] + shape[0]]
+
+
+def crop_volume(volume, geometry, offset, shape):
+    """
+    Crops a volume to a block of its grid, as a SimpleITK image keeping its physical position. Only the block is
+    copied, e.g. from a memory-mapped CT volume
+    :param volume: the (z, y, x) volume
+    :param geometry: the geometry dictionary of the volume
+    :param offset: the (z, y, x) index of the first voxel of the block in the grid
+    :param shape: the (z, y, x) shape of the block
+    :return: the SimpleITK Image of the block
+    """
+    block = volume[tuple(slice(o, o + s) for o, s in zip(offset, shape))]
+    return get_CT_image(block, get_block_geometry(geometry, offset, block.shape))
+
+
+def build_block_mask(view, reference):
+    """
+    Builds a SimpleITK label image from a cropped boolean mask, on the grid of an image cropped to the same block
+    :param view: the cropped (z, y, x) boolean mask
+    :param reference: the cropped SimpleITK Image
+    :return: the SimpleITK Image, with label 1 inside the structure
+    """
+    mask = SimpleITK.GetImageFromArray(view.astype(numpy.uint8))
+    mask.CopyInformation(reference)
+    return mask
+
+
+def build_mask_image(mask, geometry):
+    """
+    Builds a SimpleITK label image from a boolean mask
+    :param mask: the (z, y, x) boolean mask
+    :param geometry: the geometry dictionary of the mask
+    :return: the SimpleITK Image, with label 1 inside the structure
+    """
+    image = SimpleITK.GetImageFromArray(mask.astype(numpy.uint8))
+    image.SetSpacing(geometry["spacing"])
+    image.SetOrigin(geometry["origin"])
+    image.SetDirection(geometry["direction"])
+    return image
+
+
+class MaskSource:
+    """
+    Structure masks of a DICOMGroup, kept in memory as a single multi-label volume with one bit per structure,
+    packed in unsigned words. The mask of each structure is extracted on demand and stored as a block cropped to its
+    bounding box, plus a padding margin, with the offset of the block in the grid
+    """
+
+    def __init__(self, ss_image_file, ss_list_file, padding=DEFAULT_MASK_PADDING):
+        """
+        Reads the structure set written by general_utils.create_ss_NRRD
+        :param ss_image_file: the structure set image
+        :param ss_list_file: the list of the structures in the image
+        :param padding: margin in voxels around the bounding box of each structure
+        """
+        self.words, self.geometry = read_ss_image(ss_image_file)
+        self.word_bits = self.words.dtype.itemsize * 8
+        # Structures are sorted by name for a deterministic order of results, their bits come from the list
+        self.bits = {name: bit for name, bit in sorted(read_ss_list(ss_list_file).items())
+                     if bit < self.word_bits * self.words.shape[0]}
+        self.padding = padding
+        # For each axis, the OR of the words of each slice along the axis (words, slices): bit b of slice i is set if
+        # structure b has voxels in slice i. All bounding boxes are computed from these, without unpacking the masks
+        self.profiles = [numpy.bitwise_or.reduce(self.words, axis=tuple(a + 1 for a in range(3) if a != axis))
+                         for axis in range(3)]
+        self.boxes = {}
+        self.blocks = {}
+        self.voxels = {}
+
+    def get_names(self):
+        """
+        :return: the names of the structures, sorted
+        """
+        return list(self.bits.keys())
+
+    def get_bit_plane(self, name, box=None):
+        """
+        Gets the mask of a structure from its bit in the label volume
+        :param name: the name of the structure
+        :param box: the (z, y, x) slices of the region to extract, the full grid if None
+        :return: the (z, y, x) boolean mask
+        """
+        word = self.words[self.bits[name] // self.word_bits]
+        bit = self.words.dtype.type(1) << self.words.dtype.type(self.bits[name] % self.word_bits)
+        return ((word[box] if box is not None else word) & bit) != 0
+
+    def get_box(self, name):
+        """
+        Gets the bounding box of a structure, enlarged by the padding margin and clipped to the grid, computed once
+        from the bits of the slices of the label volume
+        :param name: the name of the structure
+        :return: the (z, y, x) slices of the box, None for an empty structure
+        """
+        if name not in self.boxes:
+            word, bit = divmod(self.bits[name], self.word_bits)
+            box = []
+            for axis in range(3):
+                profile = self.profiles[axis][word]
+                indexes = numpy.flatnonzero((profile >> self.words.dtype.type(bit)) & self.words.dtype.type(1))
+                if len(indexes) == 0:
+                    box = None
+                    break
+                box.append(slice(max(int(indexes[0]) - self.padding, 0),
+                                 min(int(indexes[-1]) + 1 + self.padding, len(profile))))
+            self.boxes[name] = tuple(box) if box is not None else None
+        return self.boxes[name]
+
+    def count_voxels(self, name):
+        """
+        :param name: the name of the structure
+        :return: the number of voxels of the structure
+        """
+        if name not in self.voxels:
+            self.voxels[name] = int(numpy.count_nonzero(self.get_mask_view(name)[0])) \
+                if self.get_box(name) is not None else 0
+        return self.voxels[name]
+
+    def get_mask_view(self, name):
+        """
+        Gets the mask of a structure cropped to its padded bounding box, extracted once
+        :param name: the name of the structure
+        :return: the cropped (z, y, x) boolean mask, and the (z, y, x) index of its first voxel in the grid. The mask
+                 of an empty structure is a single (empty) voxel
+        """
+        if name not in self.blocks:
+            box = self.get_box(name) if self.get_box(name) is not None else (slice(0, 1),) * 3
+            self.blocks[name] = (self.get_bit_plane(name, box), tuple(s.start for s in box))
+        return self.blocks[name]
+
+    def get_mask_array(self, name):
+        """
+        Gets the mask of a structure on the full grid
+        :param name: the name of the structure
+        :return: the (z, y, x) boolean mask
+        """
+        view, offset = self.get_mask_view(name)
+        return expand_mask(view, offset, tuple(self.geometry["shape"]))
+
+    def get_mask(self, name):
+        """
+        Gets the mask of a structure as a SimpleITK image cropped to its padded bounding box
+        :param name: the name of the structure
+        :return: the SimpleITK Image, with label 1 inside the structure
+        """
+        view, offset = self.get_mask_view(name)
+        return build_mask_image(view, get_block_geometry(self.geometry, offset, view.shape))
+
+    def crop(self, image, name):
+        """
+        Crops an image on the grid of the masks to the padded bounding box of a structure, e.g. the CT or the dose
+        :param image: the SimpleITK Image
+        :param name: the name of the structure
+        :return: the cropped SimpleITK Image
+        """
+        view, offset = self.get_mask_view(name)
+        return crop_image(image, offset, view.shape)
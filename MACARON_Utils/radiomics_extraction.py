@@ -0,0 +1,222 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import SimpleITK
+from radiomics import featureextractor
+
+from MACARON_Utils.CT_volume import load_CT_image, load_CT_volume
+from MACARON_Utils.Radiomics_Profile import RadiomicsProfile
+from MACARON_Utils.mask_source import crop_image, crop_volume, build_block_mask, get_image_geometry
+
+# Settings of the radiomic feature extractors
+DEFAULT_RADIOMICS_SETTINGS = {'binWidth': 25,
+                              'resampledPixelSpacing': None,
+                              'interpolator': SimpleITK.sitkBSpline}
+
+# Features registered in the RadiomicFeature table by populate_db() in database/Create_MACARON_Database.sql
+DB_SCHEMA_FEATURES = {
+    'shape': ['Elongation', 'Flatness', 'LeastAxisLength', 'MajorAxisLength', 'Maximum2DDiameterColumn',
+              'Maximum2DDiameterRow', 'Maximum2DDiameterSlice', 'Maximum3DDiameter', 'MeshVolume', 'MinorAxisLength',
+              'Sphericity', 'SurfaceArea', 'SurfaceVolumeRatio', 'VoxelVolume'],
+    'firstorder': ['10Percentile', '90Percentile', 'Energy', 'Entropy', 'InterquartileRange', 'Kurtosis', 'Maximum',
+                   'MeanAbsoluteDeviation', 'Mean', 'Median', 'Minimum', 'Range', 'RobustMeanAbsoluteDeviation',
+                   'RootMeanSquared', 'Skewness', 'TotalEnergy', 'Uniformity', 'Variance'],
+    'glcm': ['Autocorrelation', 'ClusterProminence', 'ClusterShade', 'ClusterTendency', 'Contrast', 'Correlation',
+             'DifferenceAverage', 'DifferenceEntropy', 'DifferenceVariance', 'Id', 'Idm', 'Idmn', 'Idn', 'Imc1',
+             'Imc2', 'InverseVariance', 'JointAverage', 'JointEnergy', 'JointEntropy', 'MCC', 'MaximumProbability',
+             'SumAverage', 'SumEntropy', 'SumSquares'],
+    'gldm': ['DependenceEntropy', 'DependenceNonUniformity', 'DependenceNonUniformityNormalized',
+             'DependenceVariance', 'GrayLevelNonUniformity', 'GrayLevelVariance', 'HighGrayLevelEmphasis',
+             'LargeDependenceEmphasis', 'LargeDependenceHighGrayLevelEmphasis', 'LargeDependenceLowGrayLevelEmphasis',
+             'LowGrayLevelEmphasis', 'SmallDependenceEmphasis', 'SmallDependenceHighGrayLevelEmphasis',
+             'SmallDependenceLowGrayLevelEmphasis'],
+    'glrlm': ['GrayLevelNonUniformity', 'GrayLevelNonUniformityNormalized', 'GrayLevelVariance',
+              'HighGrayLevelRunEmphasis', 'LongRunEmphasis', 'LongRunHighGrayLevelEmphasis',
+              'LongRunLowGrayLevelEmphasis', 'LowGrayLevelRunEmphasis', 'RunEntropy', 'RunLengthNonUniformity',
+              'RunLengthNonUniformityNormalized', 'RunPercentage', 'RunVariance', 'ShortRunEmphasis',
+              'ShortRunHighGrayLevelEmphasis', 'ShortRunLowGrayLevelEmphasis'],
+    'glszm': ['GrayLevelNonUniformity', 'GrayLevelNonUniformityNormalized', 'GrayLevelVariance',
+              'HighGrayLevelZoneEmphasis', 'LargeAreaEmphasis', 'LargeAreaHighGrayLevelEmphasis',
+              'LargeAreaLowGrayLevelEmphasis', 'LowGrayLevelZoneEmphasis', 'SizeZoneNonUniformity',
+              'SizeZoneNonUniformityNormalized', 'SmallAreaEmphasis', 'SmallAreaHighGrayLevelEmphasis',
+              'SmallAreaLowGrayLevelEmphasis', 'ZoneEntropy', 'ZonePercentage', 'ZoneVariance'],
+    'ngtdm': ['Busyness', 'Coarseness', 'Complexity', 'Contrast', 'Strength']}
+
+# Features enabled by each RadiomicsProfile, as arguments of RadiomicsFeatureExtractor.enableFeaturesByName
+# (an empty list enables all the features of a class), None to enable all features
+PROFILE_FEATURES = {RadiomicsProfile.SHAPE_ONLY: {'shape': []},
+                    RadiomicsProfile.FIRST_ORDER: {'firstorder': []},
+                    RadiomicsProfile.DB_SCHEMA: DB_SCHEMA_FEATURES,
+                    RadiomicsProfile.FULL: None}
+
+# Image volumes (with their geometry) and feature extractor of each worker process of a parallel extraction
+_worker_volumes = None
+_worker_extractor = None
+
+
+def load_image(image_file):
+    """
+    Loads the image to extract radiomic features from
+    :param image_file: a CT volume written by CT_volume.build_CT_volume (.npy), or an image file (e.g. NRRD)
+    :return: the SimpleITK Image
+    """
+    if image_file.endswith(".npy"):
+        return load_CT_image(image_file)
+    return SimpleITK.ReadImage(image_file)
+
+
+def load_volume(image_file):
+    """
+    Loads the image to extract radiomic features from as a volume, memory-mapped for the volumes written by
+    CT_volume.build_CT_volume, so that workers only copy the blocks of the structures
+    :param image_file: a volume written by CT_volume.build_CT_volume (.npy), or an image file (e.g. NRRD)
+    :return: the (z, y, x) volume and its geometry dictionary
+    """
+    if image_file.endswith(".npy"):
+        return load_CT_volume(image_file)
+    image = SimpleITK.ReadImage(image_file)
+    return SimpleITK.GetArrayFromImage(image), get_image_geometry(image)
+
+
+def build_extractor(settings=None, profile=RadiomicsProfile.FULL):
+    """
+    Builds a radiomic feature extractor with the features of a profile enabled
+    :param settings: the settings of the extractor, DEFAULT_RADIOMICS_SETTINGS if None
+    :param profile: the RadiomicsProfile of the features
+    :return: the RadiomicsFeatureExtractor
+    """
+    extractor = featureextractor.RadiomicsFeatureExtractor(
+        **(settings if settings is not None else DEFAULT_RADIOMICS_SETTINGS))
+    if PROFILE_FEATURES[profile] is None:
+        extractor.enableAllFeatures()
+    else:
+        extractor.disableAllFeatures()
+        extractor.enableFeaturesByName(**PROFILE_FEATURES[profile])
+    return extractor
+
+
+def init_radiomics_worker(image_files, settings, profile):
+    """
+    Maps the image volumes and builds the feature extractor of a worker process, once for all its structures
+    :param image_files: the image files, see load_volume
+    :param settings: the settings of the extractor
+    :param profile: the RadiomicsProfile of the features
+    """
+    global _worker_volumes, _worker_extractor
+    _worker_volumes = [load_volume(image_file) for image_file in image_files]
+    _worker_extractor = build_extractor(settings, profile)
+
+
+def extract_structure_features(extractor, images, view, offset):
+    """
+    Extracts the radiomic features of a structure from several images, cropped to the block of its mask
+    :param extractor: the RadiomicsFeatureExtractor
+    :param images: the images, on the grid of the mask
+    :param view: the mask of the structure cropped to its (padded) bounding box, see MaskSource.get_mask_view
+    :param offset: the (z, y, x) index of the first voxel of the cropped mask in the grid
+    :return: the list of feature dictionaries, one for each image
+    """
+    return extract_block_features(extractor, [crop_image(image, offset, view.shape) for image in images], view)
+
+
+def extract_block_features(extractor, blocks, view):
+    """
+    Extracts the radiomic features of a structure from several images cropped to the block of its mask
+    :param extractor: the RadiomicsFeatureExtractor
+    :param blocks: the images cropped to the block of the mask
+    :param view: the mask of the structure cropped to the same block
+    :return: the list of feature dictionaries, one for each image
+    """
+    mask = build_block_mask(view, blocks[0])
+    return [extractor.execute(block, mask) for block in blocks]
+
+
+def extract_worker_features(view, offset):
+    """
+    Extracts the radiomic features of a structure from each image volume of a worker process, building only the
+    images of the block of the structure
+    :param view: the mask of the structure cropped to its (padded) bounding box, see MaskSource.get_mask_view
+    :param offset: the (z, y, x) index of the first voxel of the cropped mask in the grid
+    :return: the list of feature dictionaries, one for each image, and the time spent on the structure in seconds
+    """
+    start = time.perf_counter()
+    blocks = [crop_volume(volume, geometry, offset, view.shape) for volume, geometry in _worker_volumes]
+    features = extract_block_features(_worker_extractor, blocks, view)
+    return features, time.perf_counter() - start
+
+
+def extract_multi_radiomics(image_files, masks, settings=None, workers=1, images=None, descriptions=None,
+                            profile=RadiomicsProfile.FULL, costs=None):
+    """
+    Extracts the radiomic features of many structures from several images sharing the geometry of the masks,
+    visiting each mask once. Images are cropped to the block of each mask before extraction. With more than one
+    worker, structures are processed by a pool of processes that map the image volumes and build their extractor
+    once, largest masks first: workers only copy the block of each structure from the (shared) volumes
+    :param image_files: the image files, see load_image
+    :param masks: the MaskSource of the structures
+    :param settings: the settings of the extractor, DEFAULT_RADIOMICS_SETTINGS if None
+    :param workers: number of processes extracting features, 1 to extract them in process
+    :param images: the images already loaded from image_files, if any, used when extracting in process
+    :param descriptions: the description of the features of each image, printed for each structure
+    :param profile: the RadiomicsProfile of the features
+    :param costs: if not None, a dictionary filled with the time spent on each structure in seconds
+    :return: a list with a dictionary of feature dictionaries for each image, indexed by structure name in the
+             order of the MaskSource. Empty structures are skipped
+    """
+    settings = settings if settings is not None else DEFAULT_RADIOMICS_SETTINGS
+    descriptions = descriptions if descriptions is not None else ["radiomic features"] * len(image_files)
+    radiomics = [{} for image_file in image_files]
+    names = []
+    for name in masks.get_names():
+        if masks.count_voxels(name) > 0:
+            names.append(name)
+        else:
+            print("Skipping radiomic features of empty structure '" + name + "'")
+    if workers > 1 and len(names) > 1:
+        order = sorted(names, key=lambda name: -masks.count_voxels(name))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_radiomics_worker,
+                                 initargs=(image_files, settings, profile)) as executor:
+            futures = {}
+            for name in order:
+                print("Calculating " + " and ".join(descriptions) + ", structure '" + name + "'")
+                futures[name] = executor.submit(extract_worker_features, *masks.get_mask_view(name))
+            for name in names:
+                features, cost = futures[name].result()
+                for i in range(len(image_files)):
+                    radiomics[i][name] = features[i]
+                if costs is not None:
+                    costs[name] = cost
+    else:
+        images = images if images is not None else [load_image(image_file) for image_file in image_files]
+        extractor = build_extractor(settings, profile)
+        for name in names:
+            print("Calculating " + " and ".join(descriptions) + ", structure '" + name + "'")
+            start = time.perf_counter()
+            features = extract_structure_features(extractor, images, *masks.get_mask_view(name))
+            for i in range(len(images)):
+                radiomics[i][name] = features[i]
+            if costs is not None:
+                costs[name] = time.perf_counter() - start
+    if costs is not None and len(costs) > 0:
+        print("Extracted '" + profile.value + "' radiomic features of " + str(len(costs)) + " structures, " +
+              "%.3f" % (sum(costs.values()) / len(costs)) + " seconds per structure")
+    return radiomics
+
+
+def extract_radiomics(image_file, masks, settings=None, workers=1, image=None, description="radiomic features",
+                      profile=RadiomicsProfile.FULL, costs=None):
+    """
+    Extracts the radiomic features of many structures from the same image, see extract_multi_radiomics
+    :param image_file: the image file, see load_image
+    :param masks: the MaskSource of the structures
+    :param settings: the settings of the extractor, DEFAULT_RADIOMICS_SETTINGS if None
+    :param workers: number of processes extracting features, 1 to extract them in process
+    :param image: the image already loaded from image_file, if any, used when extracting in process
+    :param description: the description of the features, printed for each structure
+    :param profile: the RadiomicsProfile of the features
+    :param costs: if not None, a dictionary filled with the time spent on each structure in seconds
+    :return: a dictionary of feature dictionaries, indexed by structure name in the order of the MaskSource
+    """
+    return extract_multi_radiomics([image_file], masks, settings=settings, workers=workers,
+                                   images=[image] if image is not None else None, descriptions=[description],
+                                   profile=profile, costs=costs)[0]
@@ -0,0 +1,35 @@
+import json
+import os
+
+import numpy
+
+
+def store_voxel_doses(voxel_doses, npz_file, source=None):
+    """
+    Stores the dose and volume of the voxels of the structures of a DICOMGroup in a .npz file
+    :param voxel_doses: a dictionary of (doses, volumes) float32 arrays, indexed by ROI number
+    :param npz_file: the path to the .npz file to write
+    :param source: a (JSON serializable) signature of the source files, stored with the arrays
+    """
+    arrays = {"source": numpy.array(json.dumps(source))}
+    for roi, (doses, volumes) in voxel_doses.items():
+        arrays["doses_" + str(roi)] = doses
+        arrays["volumes_" + str(roi)] = volumes
+    numpy.savez(npz_file, **arrays)
+
+
+def load_voxel_doses(npz_file, source=None):
+    """
+    Loads the dose and volume of the voxels of the structures of a DICOMGroup stored by store_voxel_doses
+    :param npz_file: the path to the .npz file
+    :param source: the signature of the source files, the file is ignored if it was stored for other sources
+    :return: a dictionary of (doses, volumes) float32 arrays indexed by ROI number, empty if the file is missing or
+             was stored for other sources
+    """
+    if not os.path.exists(npz_file):
+        return {}
+    with numpy.load(npz_file) as arrays:
+        if json.loads(str(arrays["source"])) != source:
+            return {}
+        return {int(key[len("doses_"):]): (arrays[key], arrays["volumes_" + key[len("doses_"):]])
+                for key in arrays.files if key.startswith("doses_")}
@@ -12,16 +12,519 @@
 from __future__ import division
 import pylab as pl
 from dicompylercore import dicomparser, dvh, dvhcalc
+import copy
 import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.util import Finalize
 import numpy as np
-import numpy.ma as ma
 import matplotlib.path
 from six import iteritems
 import logging
 logger = logging.getLogger('dicompylercore.dvhcalc')
 
-
-def get_dvh(structure, dose, roi, limit=None, callback=None):
+# Dose grids attached by each worker process of a parallel DVH calculation
+_shared_grids = None
+
+# Number of planes of each ROI used to estimate the error of approximate DVHs
+DEFAULT_ERROR_PLANES = 5
+
+# Number of interpolated dose planes kept by each dose grid (least recently
+# used first out)
+DOSE_PLANE_CACHE_SIZE = 8
+
+
+class DoseGrid:
+    """Decoded RT Dose grid shared by the DVH calculation of all ROIs.
+    The dose is decoded once into a float32 volume in cGy, with frames
+    sorted by z. Planes of exact frames are views of the volume, and the
+    last interpolated planes are cached for all ROIs."""
+
+    def __init__(self, dose, threshold=0.5):
+        """Decode the dose and image data of the dose grid.
+        Parameters
+        ----------
+        dose : DicomParser
+            A DicomParser instance of an RT Dose
+        threshold : float, optional
+            Max distance (mm) from z to the closest frame to skip
+            interpolation, as in DicomParser.GetDoseGrid
+        """
+        self.valid = "PixelData" in dose.ds
+        self.threshold = threshold
+        self.cache = OrderedDict()
+        self.z = None
+        self.volume = None
+        if self.valid:
+            # Get the dose and image data information
+            self.dd = dose.GetDoseData()
+            self.id = dose.GetImageData()
+            # Patient coordinates of the columns (x) and rows (y) of the grid
+            self.lut_x = np.array(self.dd['lut'][0])
+            self.lut_y = np.array(self.dd['lut'][1])
+            # Z coordinate of each frame of a multi-frame dose pixel array
+            if 'GridFrameOffsetVector' in dose.ds:
+                z_sign = 1 if dose.is_head_first_orientation() else -1
+                planes = (z_sign * np.array(dose.ds.GridFrameOffsetVector) +
+                          dose.ds.ImagePositionPatient[2])
+                order = np.argsort(planes, kind='stable')
+                self.z = planes[order]
+                pixel_array = dose.GetPixelArray()
+                scaling = self.dd['dosegridscaling'] * 100
+                self.volume = np.empty(
+                    (len(order),) + pixel_array.shape[-2:], dtype=np.float32)
+                for i, frame in enumerate(order):
+                    self.volume[i] = pixel_array[frame] * scaling
+
+    def downsample(self, stride):
+        """Return a coarser copy of the grid, keeping one row and column out
+        of stride. Each point of the copy stands for stride x stride points
+        of the grid, so contours are rasterized on stride^2 fewer points."""
+        coarse = copy.copy(self)
+        coarse.cache = OrderedDict()
+        coarse.id = dict(self.id)
+        coarse.id['pixelspacing'] = [spacing * stride for spacing in
+                                     self.id['pixelspacing']]
+        coarse.lut_x = self.lut_x[::stride]
+        coarse.lut_y = self.lut_y[::stride]
+        if self.volume is not None:
+            coarse.volume = self.volume[:, ::stride, ::stride]
+        return coarse
+
+    def get_plane(self, z):
+        """Return the dose plane (cGy) for the given z position (mm). Only
+        interpolated planes, which are not views of the volume, are cached,
+        up to DOSE_PLANE_CACHE_SIZE planes."""
+        z = float(z)
+        plane = self.cache.get(z)
+        if plane is not None:
+            self.cache.move_to_end(z)
+            return plane
+        plane = self.lookup_plane(z)
+        if plane.flags.owndata and plane.size > 0:
+            self.cache[z] = plane
+            if len(self.cache) > DOSE_PLANE_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return plane
+
+    def lookup_plane(self, z):
+        """Return the dose plane (cGy) for the given z position (mm): the
+        closest frame within the threshold, or the linear interpolation of
+        the two frames around z. Empty if z is outside of the grid."""
+        if self.z is None:
+            return np.array([])
+        # Frames lb and ub bound z, with z[lb] <= z <= z[ub] inside the grid
+        ub = min(int(np.searchsorted(self.z, z)), len(self.z) - 1)
+        lb = max(ub - 1, 0)
+        nearest = lb if abs(z - self.z[lb]) <= abs(self.z[ub] - z) else ub
+        if abs(self.z[nearest] - z) < self.threshold:
+            return self.volume[nearest]
+        if (z < self.z[0]) or (z > self.z[-1]):
+            return np.array([])
+        fz = (z - self.z[lb]) / (self.z[ub] - self.z[lb])
+        return fz * self.volume[ub] + (1.0 - fz) * self.volume[lb]
+
+
+class SharedDoseGrid(DoseGrid):
+    """Dose grid whose volume is stored in shared memory, so that it can
+    be sent to worker processes without copying it."""
+
+    def __init__(self, grid):
+        """Copy the volume of a decoded dose grid into shared memory.
+        Parameters
+        ----------
+        grid : DoseGrid
+            A valid DoseGrid of an RT Dose
+        """
+        self.valid = grid.valid
+        self.threshold = grid.threshold
+        self.cache = OrderedDict()
+        self.dd = grid.dd
+        self.id = grid.id
+        self.lut_x = grid.lut_x
+        self.lut_y = grid.lut_y
+        self.z = grid.z
+        self.shape = grid.volume.shape if grid.volume is not None else (0,)
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=max(int(np.prod(self.shape)) * 4, 1))
+        self.name = self.shm.name
+        self.volume = np.ndarray(
+            self.shape, dtype=np.float32, buffer=self.shm.buf)
+        if grid.volume is not None:
+            self.volume[:] = grid.volume
+
+    def __getstate__(self):
+        """Pickle everything but the shared memory block and the cache."""
+        state = self.__dict__.copy()
+        del state['shm']
+        del state['volume']
+        state['cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        """Attach to the shared memory block of the pickled grid. The block
+        is left out of the resource tracker of the worker: it is unlinked by
+        the process that created it."""
+        self.__dict__.update(state)
+        self.shm = attach_shared_memory(self.name)
+        self.volume = np.ndarray(
+            self.shape, dtype=np.float32, buffer=self.shm.buf)
+
+    def close(self, unlink=False):
+        """Detach from the shared memory block, freeing it if unlink."""
+        self.volume = None
+        self.cache = OrderedDict()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def attach_shared_memory(name):
+    """Attach to an existing shared memory block without registering it to
+    the resource tracker, as the track argument of Python 3.13 does. The
+    tracker is shared with the parent process and keeps a set of names, so
+    unregistering the block after attaching to it would race with the other
+    workers and with the unlink of the parent."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def init_dvh_worker(grids):
+    """Keep the shared dose grids in a worker process, detaching from their
+    shared memory blocks when the worker exits."""
+    global _shared_grids
+    _shared_grids = grids
+    for grid in grids:
+        Finalize(grid, grid.close, exitpriority=10)
+
+
+def calculate_shared_dvh(structure, index=0, limit=None, bin_width=1):
+    """Calculate the differential DVH of a structure in a worker process,
+    on the index-th dose grid shared by init_dvh_worker."""
+    return calculate_dvh(structure, _shared_grids[index], limit,
+                         bin_width=bin_width)
+
+
+def get_dvhs(structure, dose, rois=None, limit=None, callback=None,
+             workers=1, bin_width=1):
+    """Calculate cumulative DVHs in Gy for many ROIs of a DICOM RT Structure Set & Dose.
+    Files are parsed and the dose grid is decoded once for all ROIs.
+    With more than one worker, ROIs are computed by a pool of processes
+    sharing the dose grid through shared memory.
+    Parameters
+    ----------
+    structure : pydicom Dataset or filename
+        DICOM RT Structure Set used to determine the structure data.
+    dose : pydicom Dataset or filename
+        DICOM RT Dose used to determine the dose grid.
+    rois : list, optional
+        The ROI numbers to calculate the DVH of. All ROIs if not specified.
+    limit : int, optional
+        Dose limit in cGy as a maximum bin for the histogram.
+    callback : function, optional
+        A function that will be called at every iteration of the calculation.
+        With more than one worker, it is called each time an ROI is done.
+    workers : int, optional
+        Number of processes computing the DVHs, 1 to compute them in process.
+    bin_width : float, optional
+        Width of the dose bins in cGy. Wider bins use less memory, at the
+        cost of a coarser DVH (doses are floored to the bin width).
+    """
+    structures, rois, grid = load_structures(structure, dose, rois)
+    return compute_dvhs(structures, rois, grid, limit, callback, workers,
+                        bin_width)
+
+
+def get_approximate_dvhs(structure, dose, rois=None, stride=4,
+                         sample_planes=DEFAULT_ERROR_PLANES, limit=None,
+                         callback=None, workers=1, bin_width=1):
+    """Calculate approximate cumulative DVHs in Gy for many ROIs of a DICOM
+    RT Structure Set & Dose, on a dose grid downsampled in rows and columns.
+    Contours keep one point out of stride, and the error of each DVH is
+    estimated against the full resolution on a sample of its planes (see
+    estimate_dvh_error).
+    Parameters
+    ----------
+    structure : pydicom Dataset or filename
+        DICOM RT Structure Set used to determine the structure data.
+    dose : pydicom Dataset or filename
+        DICOM RT Dose used to determine the dose grid.
+    rois : list, optional
+        The ROI numbers to calculate the DVH of. All ROIs if not specified.
+    stride : int, optional
+        Downsampling factor of the rows and columns of the dose grid.
+    sample_planes : int, optional
+        Number of planes of each ROI used to estimate its error.
+    limit, callback, workers, bin_width : optional
+        As in get_dvhs.
+    Returns the DVHs and their estimated errors, indexed by ROI number.
+    """
+    structures, rois, grid = load_structures(structure, dose, rois)
+    coarse = grid.downsample(stride) if grid.valid else grid
+    coarse_structures = {roi: downsample_structure(structures[roi], stride)
+                         for roi in rois}
+    if not (workers > 1 and len(rois) > 1 and grid.valid):
+        dvhs = compute_dvhs(coarse_structures, rois, coarse, limit, callback,
+                            workers, bin_width)
+        errors = {roi: estimate_dvh_error(structures[roi], grid, coarse,
+                                          sample_planes, limit, bin_width,
+                                          stride)
+                  for roi in rois}
+        return dvhs, errors
+    # The coarse DVHs and the sampled planes of the error estimate (at full
+    # and coarse resolution) are computed by the same pool, on both grids
+    samples = {roi: get_error_sample(structures[roi], sample_planes)
+               for roi in rois}
+    sampled = [roi for roi in rois if samples[roi] is not None]
+    tasks = [(coarse_structures[roi], 1) for roi in rois] + \
+        [(samples[roi], 0) for roi in sampled] + \
+        [(downsample_structure(samples[roi], stride), 1) for roi in sampled]
+    hists = calculate_dvhs_parallel(tasks, [grid, coarse], limit, callback,
+                                    workers, bin_width)
+    dvhs = build_dvhs(coarse_structures, rois, hists[:len(rois)], bin_width)
+    errors = {roi: compare_sample_dvhs(None, None, bin_width) for roi in rois}
+    for i, roi in enumerate(sampled):
+        errors[roi] = compare_sample_dvhs(
+            hists[len(rois) + i], hists[len(rois) + len(sampled) + i],
+            bin_width)
+    return dvhs, errors
+
+
+def compute_dvhs(structures, rois, grid, limit=None, callback=None,
+                 workers=1, bin_width=1):
+    """Calculate cumulative DVHs in Gy for the given ROIs of the structures
+    loaded by load_structures, on a DoseGrid."""
+    if workers > 1 and len(rois) > 1 and grid.valid:
+        hists = calculate_dvhs_parallel(
+            [(structures[roi], 0) for roi in rois], [grid], limit, callback,
+            workers, bin_width)
+    else:
+        hists = [calculate_dvh(structures[roi], grid, limit, callback,
+                               bin_width)
+                 for roi in rois]
+    return build_dvhs(structures, rois, hists, bin_width)
+
+
+def build_dvhs(structures, rois, hists, bin_width=1):
+    """Build the cumulative DVHs in Gy of the given ROIs from their
+    differential histograms, in the order of rois."""
+    dvhs = {}
+    for roi, hist in zip(rois, hists):
+        s = structures[roi]
+        dvhs[roi] = dvh.DVH(counts=hist,
+                            bins=(np.arange(0, 2) if (hist.size == 1) else
+                                  np.arange(0, hist.size + 1) *
+                                  bin_width / 100),
+                            dvh_type='differential',
+                            dose_units='gy',
+                            name=s['name']
+                            ).cumulative
+    return dvhs
+
+
+def downsample_structure(structure, stride):
+    """Return a copy of the structure whose contours keep one point out of
+    stride, for a coarser rasterization. Contours with less than 3 points
+    left are kept as they are."""
+    coarse = dict(structure)
+    coarse['planes'] = {}
+    for z, plane in iteritems(structure['planes']):
+        coarse['planes'][z] = []
+        for c in plane:
+            data = np.asarray(c['data'], dtype=float)
+            if len(data) >= 3 * stride:
+                data = data[::stride]
+            coarse['planes'][z].append(dict(c, data=data))
+    return coarse
+
+
+def estimate_dvh_error(structure, grid, coarse, sample_planes,
+                       limit=None, bin_width=1, stride=1):
+    """Estimate the error of the DVH of a structure computed on a coarse
+    dose grid with contours downsampled by stride, comparing it with the
+    full resolution DVH on sample_planes planes evenly spaced along the
+    structure.
+    Returns a dict with the relative error of the volume, the error of the
+    mean dose (Gy) and the max error of the cumulative DVH (% of volume)."""
+    sample = get_error_sample(structure, sample_planes)
+    if (sample is None) or (not grid.valid):
+        return compare_sample_dvhs(None, None, bin_width)
+    full = calculate_dvh(sample, grid, limit, bin_width=bin_width)
+    approx = calculate_dvh(downsample_structure(sample, stride), coarse, limit,
+                           bin_width=bin_width)
+    return compare_sample_dvhs(full, approx, bin_width)
+
+
+def get_error_sample(structure, sample_planes):
+    """Return a copy of the structure restricted to sample_planes planes
+    evenly spaced along it, None if the structure has no planes."""
+    keys = sorted(structure['planes'].keys(), key=float)
+    if not len(keys):
+        return None
+    index = np.unique(np.linspace(0, len(keys) - 1,
+                                  min(sample_planes, len(keys))).round())
+    sample = dict(structure)
+    sample['planes'] = {keys[int(i)]: structure['planes'][keys[int(i)]]
+                        for i in index}
+    return sample
+
+
+def compare_sample_dvhs(full, approx, bin_width=1):
+    """Compare the differential DVHs of the sampled planes of a structure at
+    full resolution and on the coarse grid, see estimate_dvh_error. Without
+    a sample (None), the error is 0."""
+    if full is None:
+        return {'volume': 0.0, 'mean dose': 0.0, 'max dvh': 0.0}
+    full_volume = full.sum()
+    approx_volume = approx.sum()
+    if (not full_volume) or (not approx_volume):
+        empty = (not full_volume) and (not approx_volume)
+        return {'volume': 0.0 if empty else 1.0,
+                'mean dose': 0.0,
+                'max dvh': 0.0 if empty else 100.0}
+    size = max(full.size, approx.size)
+    full = np.pad(full, (0, size - full.size))
+    approx = np.pad(approx, (0, size - approx.size))
+    centers = (np.arange(size) + 0.5) * bin_width / 100
+    full_cumulative = full[::-1].cumsum()[::-1] * 100 / full_volume
+    approx_cumulative = approx[::-1].cumsum()[::-1] * 100 / approx_volume
+    return {'volume': float(abs(approx_volume - full_volume) / full_volume),
+            'mean dose': float(abs(np.dot(approx, centers) / approx_volume -
+                                   np.dot(full, centers) / full_volume)),
+            'max dvh': float(np.abs(approx_cumulative -
+                                    full_cumulative).max())}
+
+
+def get_embedded_dvhs(dose, rois=None):
+    """Get the cumulative DVHs in Gy embedded in the DVHSequence of an
+    RT Dose, indexed by ROI number. DVHs without a referenced ROI or data,
+    with relative dose or volume units, or with an unknown type are skipped.
+    Parameters
+    ----------
+    dose : pydicom Dataset or filename
+        DICOM RT Dose that may contain a DVHSequence.
+    rois : list, optional
+        The ROI numbers to get the DVH of. All ROIs if not specified.
+    """
+    ds = dicomparser.DicomParser(dose).ds
+    dvhs = {}
+    for item in ds.get('DVHSequence', []):
+        if 'DVHReferencedROISequence' not in item or \
+                'ReferencedROINumber' not in item.DVHReferencedROISequence[0]:
+            continue
+        roi = item.DVHReferencedROISequence[0].ReferencedROINumber
+        if (rois is not None) and (roi not in rois):
+            continue
+        if (item.get('DoseUnits', '').upper() != 'GY') or \
+                (item.get('DVHVolumeUnits', '').upper() != 'CM3') or \
+                (item.get('DVHType', '').upper() not in
+                 ('CUMULATIVE', 'DIFFERENTIAL')) or \
+                (len(item.get('DVHData', [])) < 2):
+            logger.debug("Skipping embedded DVH for ROI #%s", str(roi))
+            continue
+        embedded = dvh.DVH.from_dicom_dvh(ds, roi).cumulative
+        embedded.dose_units = 'gy'
+        dvhs[roi] = embedded
+    return dvhs
+
+
+def load_structures(structure, dose, rois=None):
+    """Parse an RT Structure Set and decode the grid of an RT Dose, getting
+    the planes and thickness of the given ROIs (all ROIs if None).
+    Returns the structures, the ROI numbers and the DoseGrid."""
+    rtss = dicomparser.DicomParser(structure)
+    grid = DoseGrid(dicomparser.DicomParser(dose))
+    structures = rtss.GetStructures()
+    if rois is None:
+        rois = list(structures.keys())
+    for roi in rois:
+        s = structures[roi]
+        s['planes'] = rtss.GetStructureCoordinates(roi)
+        s['thickness'] = rtss.CalculatePlaneThickness(s['planes'])
+    return structures, rois, grid
+
+
+def get_voxel_doses(structure, dose, rois=None):
+    """Get the dose (cGy) and volume (cm^3) of the voxels of many ROIs of
+    a DICOM RT Structure Set & Dose, without building their DVHs.
+    Parameters
+    ----------
+    structure : pydicom Dataset or filename
+        DICOM RT Structure Set used to determine the structure data.
+    dose : pydicom Dataset or filename
+        DICOM RT Dose used to determine the dose grid.
+    rois : list, optional
+        The ROI numbers to get the voxels of. All ROIs if not specified.
+    """
+    structures, rois, grid = load_structures(structure, dose, rois)
+    return {roi: calculate_voxel_doses(structures[roi], grid) for roi in rois}
+
+
+def calculate_voxel_doses(structure, grid):
+    """Get the dose (cGy) and volume (cm^3) of the voxels of a structure
+    on a DoseGrid, as two float32 arrays."""
+    doses = []
+    volumes = []
+    if grid.valid:
+        for z, plane in iteritems(structure['planes']):
+            doseplane = grid.get_plane(z)
+            if not len(doseplane):
+                continue
+            rows, cols, mask = get_plane_mask(plane, grid)
+            if rows is None:
+                continue
+            planedoses = doseplane[rows, cols][mask]
+            doses.append(planedoses.astype(np.float32))
+            volumes.append(np.full(
+                len(planedoses),
+                grid.id['pixelspacing'][0] * grid.id['pixelspacing'][1] *
+                structure['thickness'] / 1000, dtype=np.float32))
+    if not len(doses):
+        return np.zeros(0, np.float32), np.zeros(0, np.float32)
+    return np.concatenate(doses), np.concatenate(volumes)
+
+
+def calculate_dvhs_parallel(tasks, grids, limit, callback, workers,
+                            bin_width=1):
+    """Calculate the differential DVHs of many structures on a process pool.
+    Each task is a structure and the index of its dose grid in grids. The
+    dose grids are copied once into shared memory and attached by each
+    worker; structures with more contour points are submitted first.
+    Returns the histograms in the order of the tasks."""
+    shared = []
+    try:
+        for grid in grids:
+            shared.append(SharedDoseGrid(grid))
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_dvh_worker,
+                                 initargs=(shared,)) as executor:
+            order = sorted(
+                range(len(tasks)),
+                key=lambda i: -sum(len(c['data'])
+                                   for plane in tasks[i][0]['planes'].values()
+                                   for c in plane))
+            futures = {executor.submit(calculate_shared_dvh, tasks[i][0],
+                                       tasks[i][1], limit, bin_width): i
+                       for i in order}
+            hists = [None] * len(tasks)
+            for n, future in enumerate(as_completed(futures)):
+                hists[futures[future]] = future.result()
+                if callback:
+                    callback(n + 1, len(tasks))
+    finally:
+        for grid in shared:
+            grid.close(unlink=True)
+    return hists
+
+
+def get_dvh(structure, dose, roi, limit=None, callback=None, bin_width=1):
     """Calculate a cumulative DVH in Gy from a DICOM RT Structure Set & Dose.
     Parameters
     ----------
@@ -36,137 +539,173 @@ def get_dvh(structure, dose, roi, limit=None, callback=None):
         Dose limit in cGy as a maximum bin for the histogram.
     callback : function, optional
         A function that will be called at every iteration of the calculation.
+    bin_width : float, optional
+        Width of the dose bins in cGy.
     """
-    from dicompylercore import dicomparser
-    rtss = dicomparser.DicomParser(structure)
-    rtdose = dicomparser.DicomParser(dose)
-    structures = rtss.GetStructures()
-    s = structures[roi]
-    s['planes'] = rtss.GetStructureCoordinates(roi)
-    s['thickness'] = rtss.CalculatePlaneThickness(s['planes'])
-    hist = calculate_dvh(s, rtdose, limit, callback)
-    return dvh.DVH(counts=hist,
-                   bins=(np.arange(0, 2) if (hist.size == 1) else
-                         np.arange(0, hist.size + 1) / 100),
-                   dvh_type='differential',
-                   dose_units='gy',
-                   name=s['name']
-                   ).cumulative
-
-
-def calculate_dvh(structure, dose, limit=None, callback=None):
+    return get_dvhs(structure, dose, [roi], limit, callback,
+                    bin_width=bin_width)[roi]
+
+
+def calculate_dvh(structure, dose, limit=None, callback=None, bin_width=1):
     """Calculate the differential DVH for the given structure and dose grid.
     Parameters
     ----------
     structure : dict
         A structure (ROI) from an RT Structure Set parsed using DicomParser
-    dose : DicomParser
-        A DicomParser instance of an RT Dose
+    dose : DicomParser or DoseGrid
+        A DicomParser instance of an RT Dose, or its DoseGrid shared among ROIs
     limit : int, optional
         Dose limit in cGy as a maximum bin for the histogram.
     callback : function, optional
         A function that will be called at every iteration of the calculation.
+    bin_width : float, optional
+        Width of the dose bins in cGy.
     """
     planes = structure['planes']
+    grid = dose if isinstance(dose, DoseGrid) else DoseGrid(dose)
     logger.debug(
         "Calculating DVH of %s %s", structure['id'], structure['name'])
 
     # Create an empty array of bins to store the histogram in cGy
     # only if the structure has contour data or the dose grid exists
-    if ((len(planes)) and ("PixelData" in dose.ds)):
-
-        # Get the dose and image data information
-        dd = dose.GetDoseData()
-        id = dose.GetImageData()
+    if ((len(planes)) and grid.valid):
 
-        # Generate a 2d mesh grid to create a polygon mask in dose coordinates
-        # Code taken from Stack Overflow Answer from Joe Kington:
-        # https://stackoverflow.com/q/3654289/74123
-        # Create vertex coordinates for each grid cell
-        x, y = np.meshgrid(np.array(dd['lut'][0]), np.array(dd['lut'][1]))
-        x, y = x.flatten(), y.flatten()
-        dosegridpoints = np.vstack((x, y)).T
+        dd = grid.dd
 
-        maxdose = int(dd['dosemax'] * dd['dosegridscaling'] * 100)
+        # The maximum dose falls in the last bin
+        maxdose = dd['dosemax'] * dd['dosegridscaling'] * 100
         # Remove values above the limit (cGy) if specified
         if isinstance(limit, int):
             if (limit < maxdose):
                 maxdose = limit
-        hist = np.zeros(maxdose)
+        hist = np.zeros(int(maxdose / bin_width) + 1)
     else:
         return np.array([0])
 
     n = 0
-    planedata = {}
-    # Iterate over each plane in the structure
+    volume = 0
+    # Iterate over each plane in the structure, accumulating the histogram
     for z, plane in iteritems(planes):
         # Get the dose plane for the current structure plane
-        doseplane = dose.GetDoseGrid(z)
-        planedata[z] = calculate_plane_histogram(
-            plane, doseplane, dosegridpoints,
-            maxdose, dd, id, structure, hist)
+        doseplane = grid.get_plane(z)
+        volume += calculate_plane_histogram(
+            plane, doseplane, grid, hist, bin_width, structure)
         n += 1
         if callback:
             callback(n, len(planes))
+    if not hist.any():
+        return np.array([0])
     # Volume units are given in cm^3
-    volume = sum([p[1] for p in planedata.values()]) / 1000
+    volume = volume / 1000
     # Rescale the histogram to reflect the total volume
-    hist = sum([p[0] for p in planedata.values()])
-    hist = hist * volume / sum(hist)
+    hist *= volume / hist.sum()
     # Remove the bins above the max dose for the structure
     hist = np.trim_zeros(hist, trim='b')
 
     return hist
 
 
-def calculate_plane_histogram(plane, doseplane, dosegridpoints,
-                              maxdose, dd, id, structure, hist):
-    """Calculate the DVH for the given plane in the structure."""
-    contours = [[x[0:2] for x in c['data']] for c in plane]
-
+def calculate_plane_histogram(plane, doseplane, grid, hist, bin_width,
+                              structure):
+    """Add the DVH of the given plane in the structure to the histogram,
+    returning the volume (mm^3) of the structure in the plane."""
     # If there is no dose for the current plane, go to the next plane
     if not len(doseplane):
-        return (np.arange(0, maxdose), 0)
-
-    # Create a zero valued bool grid
-    grid = np.zeros((dd['rows'], dd['columns']), dtype=np.uint8)
-
-    # Calculate the histogram for each contour in the plane
-    # and boolean xor to remove holes
-    for i, contour in enumerate(contours):
-        m = get_contour_mask(dd, id, dosegridpoints, contour)
-        grid = np.logical_xor(m.astype(np.uint8), grid).astype(np.bool)
+        return 0
 
-    hist, vol = calculate_contour_dvh(
-        grid, doseplane, maxdose, dd, id, structure)
-    return (hist, vol)
+    rows, cols, mask = get_plane_mask(plane, grid)
+    if rows is None:
+        return 0
 
+    return calculate_contour_dvh(
+        mask, doseplane[rows, cols], hist, bin_width, grid.id, structure)
 
-def get_contour_mask(dd, id, dosegridpoints, contour):
-    """Get the mask for the contour with respect to the dose plane."""
-    doselut = dd['lut']
 
-    c = matplotlib.path.Path(list(contour))
-    grid = c.contains_points(dosegridpoints)
-    grid = grid.reshape((len(doselut[1]), len(doselut[0])))
+def get_plane_mask(plane, grid):
+    """Get the mask of the given plane in the structure with respect to the
+    dose grid. Contours are rasterized only inside the bounding box of the
+    contours of the plane, returned as the rows and columns of the mask."""
+    contours = [np.asarray(c['data'], dtype=float)[:, 0:2] for c in plane]
 
-    return grid
+    # Crop the dose grid to the bounding box of all contours
+    points = np.concatenate(contours)
+    rows, cols = get_grid_extents(grid, points)
+    if rows is None:
+        return None, None, None
 
+    # Create a zero valued bool grid
+    mask = np.zeros((rows.stop - rows.start, cols.stop - cols.start),
+                    dtype=bool)
 
-def calculate_contour_dvh(mask, doseplane, maxdose, dd, id, structure):
-    """Calculate the differential DVH for the given contour and dose plane."""
-    # Multiply the structure mask by the dose plane to get the dose mask
-    mask = ma.array(doseplane * dd['dosegridscaling'] * 100, mask=~mask)
-    # Calculate the differential dvh
-    hist, edges = np.histogram(mask.compressed(),
-                               bins=maxdose,
-                               range=(0, maxdose))
+    # Calculate the mask for each contour in the plane
+    # and boolean xor to remove holes
+    for i, contour in enumerate(contours):
+        c_rows, c_cols, m = get_contour_mask(grid, contour)
+        if m is not None:
+            mask[c_rows.start - rows.start:c_rows.stop - rows.start,
+                 c_cols.start - cols.start:c_cols.stop - cols.start] ^= m
+
+    return rows, cols, mask
+
+
+def get_lut_extents(lut, vmin, vmax):
+    """Get the slice of the (monotonic) LUT within the given range."""
+    index = np.nonzero((lut >= vmin) & (lut <= vmax))[0]
+    if not len(index):
+        return None
+    return slice(index[0], index[-1] + 1)
+
+
+def get_grid_extents(grid, points):
+    """Get the rows and columns of the dose grid in the bounding box
+    of the given (x, y) points."""
+    cols = get_lut_extents(grid.lut_x, points[:, 0].min(), points[:, 0].max())
+    rows = get_lut_extents(grid.lut_y, points[:, 1].min(), points[:, 1].max())
+    if rows is None or cols is None:
+        return None, None
+    return rows, cols
+
+
+def get_contour_mask(grid, contour):
+    """Get the mask for the contour with respect to the dose plane,
+    cropped to the bounding box of the contour."""
+    rows, cols = get_grid_extents(grid, contour)
+    if rows is None:
+        return None, None, None
+
+    # Generate a 2d mesh grid to create a polygon mask in dose coordinates
+    # Code taken from Stack Overflow Answer from Joe Kington:
+    # https://stackoverflow.com/q/3654289/74123
+    x, y = np.meshgrid(grid.lut_x[cols], grid.lut_y[rows])
+    dosegridpoints = np.vstack((x.flatten(), y.flatten())).T
+
+    c = matplotlib.path.Path(contour)
+    mask = c.contains_points(dosegridpoints)
+    mask = mask.reshape((rows.stop - rows.start, cols.stop - cols.start))
+
+    return rows, cols, mask
+
+
+def calculate_contour_dvh(mask, doseplane, hist, bin_width, id, structure):
+    """Add the differential DVH for the given contour and dose plane to the
+    histogram, returning the volume (mm^3) of the contour."""
+    # Bin of the dose of each voxel in the structure mask
+    dosebins = np.floor(doseplane[mask] / bin_width).astype(np.int64)
+    # Doses equal to the upper edge fall in the last bin, higher are dropped
+    maxbin = len(hist) - 1
+    dosebins[doseplane[mask] == (maxbin + 1) * bin_width] = maxbin
+    dosebins = dosebins[(dosebins >= 0) & (dosebins <= maxbin)]
+    if not len(dosebins):
+        return 0
+    # Accumulate the differential dvh, up to the maximum dose of the plane
+    counts = np.bincount(dosebins)
+    hist[:len(counts)] += counts
 
     # Calculate the volume for the contour for the given dose plane
-    vol = sum(hist) * ((id['pixelspacing'][0]) *
-                       (id['pixelspacing'][1]) *
-                       (structure['thickness']))
-    return hist, vol
+    vol = len(dosebins) * ((id['pixelspacing'][0]) *
+                           (id['pixelspacing'][1]) *
+                           (structure['thickness']))
+    return vol
 
 # ========================== Test DVH Calculation =========================== #
 
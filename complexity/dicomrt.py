@@ -13,9 +13,15 @@ from pydicom.valuerep import IS
 class RTPlan:
     """Class that parses and returns formatted DICOM RT Plan data."""
 
-    def __init__(self, filename: str) -> None:
+    def __init__(self, filename: str = None, dataset: dicom.Dataset = None) -> None:
 
-        if filename:
+        if dataset is not None:
+            # Already parsed RT Plan, shared by the caller
+            self.plan = dict()
+            self.ds = dataset
+            if "SOPClassUID" not in self.ds:
+                raise AttributeError
+        elif filename:
             self.plan = dict()
             try:
                 # Only pydicom 0.9.5 and above supports the force read argument
@@ -792,6 +792,18 @@ BEGIN
 	into newID;
 END //
 
+/* Procedure to count the details of a dvh, which has none if it was stored with its scalar metrics only */
+DROP PROCEDURE IF EXISTS count_dvh_details //
+CREATE PROCEDURE count_dvh_details (
+    IN d_id int unsigned,
+    OUT n_details int unsigned)
+BEGIN
+	select count(*)
+    from DVHDetail
+    where dvh_id = d_id
+	into n_details;
+END //
+
 
 
 
@@ -3,7 +3,7 @@ import configparser
 import mysql.connector
 
 from MACARON_Utils.DICOM_Study import DICOMStudy
-from MACARON_Utils.DICOM_utils import build_DVH_info
+from MACARON_Utils.Radiomics_Profile import RadiomicsProfile
 
 
 def connect(username, password):
@@ -155,7 +155,7 @@ def store_radiomics(db, dg, g_id):
     @param dg: DICOM Group
     @return: the radiomic_ids
     """
-    radiomics = dg.calculate_radiomics()
+    radiomics = dg.radiomics if dg.radiomics is not None else dg.calculate_radiomics(profile=RadiomicsProfile.DB_SCHEMA)
     radiomic_ids = []
     for structure in radiomics:
         gs_id = call_procedure(db, "get_structure_id", (g_id, structure, 0), 1)[0]
@@ -193,33 +193,31 @@ def store_dvh(db, dg, g_id, img_folder):
     @param dg: DICOM Group
     @return: the pc_ids
     """
-    dvhs, dvh_fig = dg.generate_DVH()
+    dvh_records = dg.get_DVH_records()
     dvh_img_path = dg.print_dvh(output_folder=img_folder)
 
     dvh_ids = []
-    if dvhs is not None:
-        for structure in dvhs:
-            dvh_info = build_DVH_info(dvhs[structure])
+    if dvh_records is not None:
+        for structure in dvh_records:
+            dvh_info = dvh_records[structure]
             gs_id = call_procedure(db, "get_structure_id", (g_id, dvh_info["Structure"], 0), 1)[0]
 
             check_id = call_procedure(db, "get_dvh", (gs_id, 0), 1)[0]
             if check_id is None:
                 # Add DVH
-                params = (gs_id, dvh_img_path, float(dvh_info["abs volume"]), dvh_info["type"], dvh_info["volume unit"],
-                          dvh_info["dose unit"], float(dvh_info["Max Dose"]), float(dvh_info["Min Dose"]),
-                          float(dvh_info["Mean Dose"]), float(dvh_info["D100"].value), float(dvh_info["D98"].value),
-                          float(dvh_info["D95"].value), float(dvh_info["D2cc"].value), 0)
+                params = (gs_id, dvh_img_path, dvh_info["abs volume"], dvh_info["type"], dvh_info["volume unit"],
+                          dvh_info["dose unit"], dvh_info["Max Dose"], dvh_info["Min Dose"],
+                          dvh_info["Mean Dose"], dvh_info["D100"], dvh_info["D98"],
+                          dvh_info["D95"], dvh_info["D2cc"], 0)
                 dvh_id = call_procedure(db, "add_dvh", params, 1)[0]
                 dvh_ids.append(dvh_id)
-
-                # Add DVH detail with all data
-                counts = [float(x) for x in dvh_info["counts"].split(',')]
-                bins = [float(x) for x in dvh_info["bins"].split(',')]
-                for i in range(0, len(counts)):
-                    params = (dvh_id, counts[i], bins[i], 0)
-                    dvh_detail_id = call_procedure(db, "add_dvh_detail", params, 1)
-
+                store_dvh_details(db, dvh_id, dvh_info)
                 print("DVH '" + dvh_info["Structure"] + "' stored in the DB")
+            elif call_procedure(db, "count_dvh_details", (check_id, 0), 1)[0] == 0:
+                # The DVH was stored by store_dvh_metrics, without its curve
+                store_dvh_details(db, check_id, dvh_info)
+                print("DVH details of '" + dvh_info["Structure"] + "' stored in the DB")
+                dvh_ids.append(check_id)
             else:
                 print("DVH for structure '" + dvh_info["Structure"] + "' already exists, not adding it again")
                 dvh_ids.append(check_id)
@@ -229,6 +227,21 @@ def store_dvh(db, dg, g_id, img_folder):
     return dvh_ids
 
 
+def store_dvh_details(db, dvh_id, dvh_info):
+    """
+    Stores the curve of a DVH in the MySQL database
+    @param db: database connection
+    @param dvh_id: the id of the DVH
+    @param dvh_info: the DVH record, see DICOM_utils.build_DVH_record
+    @return: the dvh_detail_ids
+    """
+    dvh_detail_ids = []
+    for count, dose_bin in zip(dvh_info["counts"].tolist(), dvh_info["bins"].tolist()):
+        params = (dvh_id, count, dose_bin, 0)
+        dvh_detail_ids.append(call_procedure(db, "add_dvh_detail", params, 1))
+    return dvh_detail_ids
+
+
 def create_patient(db, dg):
     """
     Stores all data from a DICOM Group in a database
@@ -262,6 +275,38 @@ def store_cp_metrics(db, dg, group_id):
     return cpm_ids
 
 
+def store_dvh_metrics(db, dg, g_id):
+    """
+    Stores the scalar DVH metrics of the structures of a DICOM Group in the MySQL database, without DVH details
+    @param db: database connection
+    @param dg: DICOM Group
+    @return: the dvh_ids
+    """
+    dvh_metrics = dg.dvh_metrics if dg.dvh_metrics is not None else dg.calculate_DVH_metrics()
+
+    dvh_ids = []
+    if dvh_metrics is not None:
+        for structure in dvh_metrics:
+            metrics = dvh_metrics[structure]
+            gs_id = call_procedure(db, "get_structure_id", (g_id, metrics["Structure"], 0), 1)[0]
+
+            check_id = call_procedure(db, "get_dvh", (gs_id, 0), 1)[0]
+            if check_id is None:
+                params = (gs_id, "", metrics["abs volume"], "cumulative", metrics["volume unit"],
+                          metrics["dose unit"], metrics["Max Dose"], metrics["Min Dose"],
+                          metrics["Mean Dose"], metrics["D100"], metrics["D98"],
+                          metrics["D95"], metrics["D2cc"], 0)
+                dvh_ids.append(call_procedure(db, "add_dvh", params, 1)[0])
+                print("DVH metrics of '" + metrics["Structure"] + "' stored in the DB")
+            else:
+                print("DVH for structure '" + metrics["Structure"] + "' already exists, not adding it again")
+                dvh_ids.append(check_id)
+    else:
+        print("Cannot compute DVH metrics: No RT_STRUCT or RT_DOSE file")
+
+    return dvh_ids
+
+
 def store_all(dg, username, password, img_folder):
     """
     Stores all data from a DICOM Group in a database
@@ -289,8 +334,15 @@ def store(study, patient, db_conn, group_id, img_folder):
         return store_plan_metric(db_conn, patient, group_id, img_folder)
     elif study is DICOMStudy.RADIOMIC_FEATURES:
         return store_radiomics(db_conn, patient, group_id)
+    elif study is DICOMStudy.ALL_RADIOMIC_FEATURES:
+        # Only CT features have a table in the database, dose features are computed in the same pass
+        if patient.radiomics is None or patient.radiomics_dose is None:
+            patient.calculate_all_radiomics(profile=RadiomicsProfile.DB_SCHEMA)
+        return store_radiomics(db_conn, patient, group_id)
     elif study is DICOMStudy.DVH_IMG or study is DICOMStudy.DVH_DATA:
         return store_dvh(db_conn, patient, group_id, img_folder)
+    elif study is DICOMStudy.DVH_METRICS:
+        return store_dvh_metrics(db_conn, patient, group_id)
     elif study is DICOMStudy.CONTROL_POINT_METRICS:
         return store_cp_metrics(db_conn, patient, group_id)
     else:
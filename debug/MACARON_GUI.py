@@ -14,6 +14,7 @@ from PIL import Image, ImageTk
 
 from MACARON_Utils.DICOM_Group import DICOMGroup
 from MACARON_Utils.DICOM_Study import DICOMStudy
+from MACARON_Utils.DICOM_scanner import find_DICOM_groups
 from MACARON_Utils.general_utils import clear_folder
 from database import DB_Manager
 from database.DB_Manager import connect, create_patient
@@ -23,32 +24,6 @@ TMP_FOLDER = "tmp"
 OUT_FOLDER = "output"
 
 
-def find_DICOM_groups(main_folder, tmp_folder):
-    """
-    Returns an array of dicom groups in the main folder
-    @param main_folder: root folder
-    @return: array of dicom groups
-    """
-
-    groups = []
-    rec_find_DICOM_groups(main_folder, tmp_folder, groups)
-    return groups
-
-
-def rec_find_DICOM_groups(main_folder, tmp_folder, groups):
-    dg = DICOMGroup(dicom_folder=main_folder,
-                    group_name=main_folder.split('/')[-1] if "/" in main_folder else main_folder,
-                    tmp_folder=tmp_folder)
-    if dg.load_folder() is True:
-        print("Found Patient #" + str(len(groups) + 1) + ": " + dg.get_name())
-        groups.append(dg)
-    for subfolder_name in os.listdir(main_folder):
-        subfolder_path = main_folder + "/" + subfolder_name
-        if os.path.isdir(subfolder_path):
-            rec_find_DICOM_groups(subfolder_path, tmp_folder, groups)
-    return groups
-
-
 def check_folder(dicom_folder):
     patients = []
     dg = DICOMGroup(dicom_folder=dicom_folder,
@@ -88,7 +63,9 @@ class MacaronGUI(tkinter.Frame):
             ["Structures", BooleanVar(value=True), DICOMStudy.STRUCTURES],
             ["DVH Data", BooleanVar(value=True), DICOMStudy.DVH_DATA],
             ["DVH Plot", BooleanVar(value=True), DICOMStudy.DVH_IMG],
+            ["DVH Metrics", BooleanVar(value=False), DICOMStudy.DVH_METRICS],
             ["Radiomic Features", BooleanVar(value=True), DICOMStudy.RADIOMIC_FEATURES],
+            ["CT and Dose Radiomic Features", BooleanVar(value=False), DICOMStudy.ALL_RADIOMIC_FEATURES],
             ["Plan", BooleanVar(value=True), DICOMStudy.PLAN_DETAIL],
             ["Plan Metrics Data", BooleanVar(value=True), DICOMStudy.PLAN_METRICS_DATA],
             ["Plan Metrics Plots", BooleanVar(value=True), DICOMStudy.PLAN_METRICS_IMG],
@@ -247,6 +224,8 @@ class MacaronGUI(tkinter.Frame):
                 progress_var.set(progress)
                 clean_folder = False
                 study_index = study_index + 1
+            # Releases datasets and results of the patient before moving to the next one
+            patient.close()
 
         progress_bar.stop()
         self.run_button['state'] = "normal"
@@ -1,8 +1,8 @@
 import configparser
 import os.path
 
-from MACARON_Utils.DICOM_Group import DICOMGroup
 from MACARON_Utils.DICOM_Study import DICOMStudy
+from MACARON_Utils.DICOM_scanner import iterate_cohort
 from MACARON_Utils.general_utils import clear_folder, write_dict
 
 from database import DB_Manager
@@ -12,31 +12,6 @@ TMP_FOLDER = "tmp"
 OUTPUT_FOLDER = "output"
 
 
-def find_DICOM_groups(main_folder, tmp_folder):
-    """
-    Returns an array of dicom groups in the main folder
-    @param main_folder: root folder
-    @return: array of dicom groups
-    """
-
-    groups = []
-    rec_find_DICOM_groups(main_folder, tmp_folder, groups)
-    return groups
-
-
-def rec_find_DICOM_groups(main_folder, tmp_folder, groups):
-    dg = DICOMGroup(dicom_folder=main_folder,
-                    group_name=main_folder.split('/')[-1] if "/" in main_folder else main_folder,
-                    tmp_folder=tmp_folder)
-    if dg.load_folder() is True:
-        print("Found Patient #" + str(len(groups) + 1) + ": " + dg.get_name())
-        groups.append(dg)
-    for subfolder_name in os.listdir(main_folder):
-        subfolder_path = main_folder + "/" + subfolder_name
-        if os.path.isdir(subfolder_path):
-            rec_find_DICOM_groups(subfolder_path, tmp_folder, groups)
-    return groups
-
 if __name__ == "__main__":
 
     # Load configuration parameters
@@ -55,9 +30,9 @@ if __name__ == "__main__":
 
     if os.path.exists(MAIN_FOLDER) and os.path.isdir(MAIN_FOLDER):
 
-        groups = find_DICOM_groups(MAIN_FOLDER, TMP_FOLDER)
-
-        for group in groups:
+        # Groups are processed one at a time, and released after reporting
+        for group, results in iterate_cohort(MAIN_FOLDER, TMP_FOLDER, studies=[DICOMStudy.CONTROL_POINT_METRICS],
+                                             output_folder=OUTPUT_FOLDER):
 
             obs = group.get_rtp_objects()
             #DB_Manager.store_all(group, config["database"]["username"], config["database"]["password"], OUTPUT_FOLDER)
@@ -76,7 +51,6 @@ if __name__ == "__main__":
             # #
             # # # Calculating RTPlan metrics
             # rtp_metrics = group.calculate_RTPlan_metrics(output_folder=OUTPUT_FOLDER)
-            group.report(studies=[DICOMStudy.CONTROL_POINT_METRICS], output_folder=OUTPUT_FOLDER)
             print("THE END")
 
     else:
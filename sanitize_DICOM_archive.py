@@ -0,0 +1,14 @@
+import os
+import sys
+
+from MACARON_Utils.DICOM_scanner import sanitize_DICOM_archive
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("Usage: python sanitize_DICOM_archive.py <DICOM folder> [number of processes]")
+    elif os.path.exists(sys.argv[1]) and os.path.isdir(sys.argv[1]):
+        n_updated = sanitize_DICOM_archive(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
+        print(str(n_updated) + " DICOM files were sanitized")
+    else:
+        print("Folder '" + sys.argv[1] + "' does not exist or it is not a folder")